@@ -0,0 +1,276 @@
+import warnings
+import torch
+from transformers import StaticCache
+from utils import TunesFormer, sample_patch
+from config import *
+
+PATCH_BUCKETS = (1, 8, 32, 128)  # the numbers of patches the patch-level step is compiled for
+
+
+class StaticBatchCache:
+    """
+    The static key/value buffers of a batch for CompiledTunesFormer.
+    The batch keeps its size when sequences end, rows maps the active sequences to their buffer rows.
+    """
+
+    def __init__(self, model: TunesFormer, batch_size: int):
+        self.patch_cache = static_cache(
+            model.patch_level_decoder.base, batch_size, model.device
+        )
+        self.char_cache = static_cache(
+            model.char_level_decoder.base.transformer, batch_size, model.device
+        )
+        self.batch_size = batch_size
+        self.num_patches = 0
+        self.rows = torch.arange(batch_size, device=model.device)
+
+    def reset(self, batch_size: int):
+        """
+        Start a new batch, the stale buffers are masked out until they are overwritten.
+        """
+        self.num_patches = 0
+        self.rows = torch.arange(batch_size, device=self.rows.device)
+
+    def batch_select_indices(self, indices: torch.Tensor):
+        self.rows = self.rows[indices]
+
+    def crop(self, max_length: int):
+        """
+        Keep the first max_length patch positions, the later ones are masked out until they are overwritten.
+        """
+        self.num_patches = min(self.num_patches, max_length)
+
+
+def static_cache(transformer, batch_size: int, device) -> StaticCache:
+    """
+    A StaticCache allocated ahead of the first step, so the compiled steps never see it uninitialized.
+    :param transformer: the GPT2Model whose blocks fill the cache, the cache takes the dtype of their weights
+    """
+    config = transformer.config
+    cache = StaticCache(config, max_cache_len=config.max_position_embeddings)
+    cache.early_initialization(
+        batch_size,
+        config.n_head,
+        config.n_embd // config.n_head,
+        next(transformer.h.parameters()).dtype,
+        device,
+    )
+    return cache
+
+
+def seek_cache(cache: StaticCache, position: int):
+    """
+    Point the next write of a StaticCache at a position.
+    Before transformers 5 the layers write at the cache_position of the step, from 5 on they write after
+    the length they have cached so far, which the buckets, crops and new batches have to move back.
+    """
+    for layer in cache.layers:
+        if hasattr(layer, "cumulative_length"):
+            layer.cumulative_length.fill_(position)
+
+
+class CompiledTunesFormer:
+    """
+    Runs the decode steps of a TunesFormer through torch.compile with static shapes.
+    The char-level step always takes one character of the whole batch against a cache of PATCH_SIZE positions,
+    the patch-level step takes the embedded new patches padded to one of PATCH_BUCKETS.
+    Both steps run uncompiled when torch.compile is unavailable.
+    """
+
+    def __init__(
+        self,
+        model: TunesFormer,
+        batch_sizes=(1,),
+        mode: str = None,
+        buckets=PATCH_BUCKETS,
+    ):
+        """
+        Compile the decode steps and warm them up.
+        :param batch_sizes: the batch sizes to compile for at start-up, others compile on first use
+        :param mode: the torch.compile mode, e.g. reduce-overhead to capture CUDA graphs
+        """
+        self.model = model
+        self.buckets = sorted(buckets)
+        self.caches = {}
+        self.compiled = False
+        try:
+            self.patch_step = torch.compile(self.eager_patch_step, mode=mode, dynamic=False)
+            self.char_step = torch.compile(self.eager_char_step, mode=mode, dynamic=False)
+            for batch_size in batch_sizes:
+                self.warmup(batch_size)
+
+            self.compiled = True
+
+        except Exception as e:
+            warnings.warn(f"torch.compile is unavailable, decoding uncompiled: {e}")
+            self.patch_step = self.eager_patch_step
+            self.char_step = self.eager_char_step
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def eager_patch_step(
+        self,
+        inputs_embeds: torch.Tensor,
+        cache_position: torch.Tensor,
+        past_key_values: StaticCache,
+    ):
+        return self.model.patch_level_decoder.base(
+            inputs_embeds=inputs_embeds,
+            past_key_values=past_key_values,
+            cache_position=cache_position,
+            # the positions of a pre-allocated cache cannot be read from its contents
+            position_ids=cache_position.unsqueeze(0),
+            use_cache=True,
+        ).last_hidden_state
+
+    def eager_char_step(
+        self,
+        inputs_embeds: torch.Tensor,
+        cache_position: torch.Tensor,
+        past_key_values: StaticCache,
+    ):
+        logits = self.model.char_level_decoder.base(
+            inputs_embeds=inputs_embeds,
+            past_key_values=past_key_values,
+            cache_position=cache_position,
+            # the positions of a pre-allocated cache cannot be read from its contents
+            position_ids=cache_position.unsqueeze(0),
+            use_cache=True,
+        ).logits
+        return torch.nn.functional.softmax(logits[:, -1], dim=-1)
+
+    @torch.inference_mode()
+    def warmup(self, batch_size: int):
+        """
+        Trace every bucket of the patch-level step and the char-level step for a batch size.
+        """
+        cache = self.new_cache(batch_size)
+        for bucket in self.buckets:
+            patches = torch.zeros(
+                (batch_size, bucket, PATCH_SIZE), dtype=torch.long, device=self.device
+            )
+            seek_cache(cache.patch_cache, 0)
+            self.patch_step(
+                self.model.patch_level_decoder.embed_patches(patches),
+                torch.arange(bucket, device=self.device),
+                cache.patch_cache,
+            )
+
+        embeddings = torch.zeros(
+            (batch_size, 1, self.model.char_level_decoder.config.n_embd),
+            device=self.device,
+            dtype=self.model.dtype,
+        )
+        seek_cache(cache.char_cache, 0)
+        self.char_step(
+            embeddings, torch.zeros(1, dtype=torch.long, device=self.device), cache.char_cache
+        )
+
+    def new_cache(self, batch_size: int) -> StaticBatchCache:
+        """
+        The static buffers of a batch size, reused across batches so the compiled steps are not traced again.
+        """
+        if batch_size not in self.caches:
+            self.caches[batch_size] = StaticBatchCache(self.model, batch_size)
+
+        cache = self.caches[batch_size]
+        cache.reset(batch_size)
+        return cache
+
+    def encode(self, patches: torch.Tensor, past_key_values: StaticBatchCache):
+        """
+        Encode the new patches of the whole batch in bucketed chunks.
+        :param patches: the new patches of every buffer row in shape [batch_size, n, PATCH_SIZE]
+        :return: the encoded last patch of every buffer row
+        """
+        max_patches = self.model.patch_level_decoder.base.config.max_position_embeddings
+        start = 0
+        while start < patches.shape[1]:
+            num_patches = patches.shape[1] - start
+            position = past_key_values.num_patches
+            fits = [b for b in self.buckets if position + b <= max_patches]
+            if not fits:
+                raise ValueError(f"The patches exceed the {max_patches} patch positions")
+
+            bucket = min([b for b in fits if b >= num_patches], default=max(fits))
+            chunk = patches[:, start : start + bucket]
+            num_patches = chunk.shape[1]
+            if num_patches < bucket:
+                chunk = torch.nn.functional.pad(chunk, (0, 0, 0, bucket - num_patches))
+
+            seek_cache(past_key_values.patch_cache, position)
+            # the patches are embedded uncompiled, with the embedding columns cached between steps
+            hidden_states = self.patch_step(
+                self.model.patch_level_decoder.embed_patches(chunk),
+                torch.arange(position, position + bucket, device=self.device),
+                past_key_values.patch_cache,
+            )
+            past_key_values.num_patches += num_patches
+            start += num_patches
+
+        return hidden_states[:, num_patches - 1]
+
+    def generate_batch(
+        self,
+        patches: torch.Tensor,
+        tokens: torch.Tensor,
+        top_p: float = 1,
+        top_k: int = 0,
+        temperature: float = 1,
+        random_states: list = None,
+        past_key_values: StaticBatchCache = None,
+        constrained: bool = False,
+        line_starts: list = None,
+    ):
+        """
+        The compiled version of TunesFormer.generate_batch, it samples the same patches.
+        :param past_key_values: the static buffers of the batch from new_cache
+        """
+        rows = past_key_values.rows
+        batch_patches = torch.zeros(
+            (past_key_values.batch_size, *patches.shape[1:]),
+            dtype=torch.long,
+            device=self.device,
+        )
+        batch_patches[rows] = patches.to(self.device)
+        encoded_patch = self.encode(batch_patches, past_key_values)
+        wte = self.model.char_level_decoder.base.transformer.wte.weight
+
+        def char_step(new_tokens: torch.Tensor, position: int):
+            batch_tokens = torch.zeros(
+                (past_key_values.batch_size, new_tokens.shape[1]),
+                dtype=torch.long,
+                device=self.device,
+            )
+            batch_tokens[rows] = new_tokens
+            inputs_embeds = torch.nn.functional.embedding(batch_tokens, wte)
+            if position == None:
+                # the encoded patch takes the place of bos
+                inputs_embeds[:, 0] = encoded_patch
+                position = 0
+
+            for j in range(inputs_embeds.shape[1]):
+                seek_cache(past_key_values.char_cache, position)
+                probs = self.char_step(
+                    inputs_embeds[:, j : j + 1].contiguous(),
+                    torch.tensor([position], device=self.device),
+                    past_key_values.char_cache,
+                )
+                position += 1
+
+            return probs[rows], position
+
+        return sample_patch(
+            char_step,
+            len(patches),
+            tokens,
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+            random_states=random_states,
+            device=self.device,
+            constrained=constrained,
+            line_starts=line_starts,
+        )
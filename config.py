@@ -2,6 +2,9 @@ PATCH_LENGTH = 128  # Patch Length
 PATCH_SIZE = 32  # Patch Size
 PATCH_NUM_LAYERS = 9  # Number of layers in the encoder
 CHAR_NUM_LAYERS = 3  # Number of layers in the decoder
+HIDDEN_SIZE = 768  # Hidden size of the encoder and decoder layers
+NUM_HEADS = 12  # Number of attention heads of the encoder and decoder layers
+LAYER_NORM_EPS = 1e-5  # Epsilon of the layer norms
 NUM_EPOCHS = 32  # Number of epochs to train for (if early stopping doesn't intervene)
 LEARNING_RATE = 5e-5  # Learning rate for the optimizer
 PATCH_SAMPLING_BATCH_SIZE = 0  # Batch size for training patch, 0 for full context
@@ -11,3 +14,9 @@ DATASET = "EMelodyGen"  # Dataset name
 OUTPUT_PATH = "./output"  # The output directory for weights file
 EXPERIMENT_DIR = "./exps"  # Saving path for survey results
 TEMP_DIR = "./__pycache__"  # Cache directory for downloading dataset
+MODEL_CACHE_BYTES = 4 * 1024**3  # Memory budget of the models kept loaded for inference
+PREFIX_CACHE_BYTES = 256 * 1024**2  # Memory budget of the prompt states kept by each engine
+EOS_CHECK_INTERVAL = 4  # Characters sampled between the checks for eos of a batch without seeds
+FINETUNE_NUM_EPOCHS = 4  # Number of epochs to fine-tune the extra heads and exits for
+FINETUNE_LEARNING_RATE = 1e-3  # Learning rate for fine-tuning the extra heads and exits
+HEAD_LOSS_DECAY = 0.8  # Loss weight decay of each head further ahead
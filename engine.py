@@ -0,0 +1,583 @@
+import os
+import re
+import time
+import torch
+import asyncio
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from transformers import GPT2Config, DynamicCache
+from utils import (
+    Patchilizer,
+    TunesFormer,
+    GenerationState,
+    PrefixState,
+    RandomState,
+    ExitStats,
+    repeat_cache,
+    DEVICE,
+)
+from speculative import NGramDraft
+from precision import convert_precision
+from compiled import CompiledTunesFormer
+from onnx_backend import OnnxTunesFormer
+from config import *
+
+
+@dataclass
+class GenerationParams:
+    """
+    The sampling and batching parameters of a generation request.
+    """
+
+    num_tunes: int = 1
+    max_patch: int = 128
+    top_p: float = 0.8
+    top_k: int = 8
+    temperature: float = 1.2
+    seed: int = None
+    batch_size: int = 1
+    num_draft: int = 0  # characters drafted per forward, 0 disables speculative decoding
+    constrained: bool = False  # mask the characters that can never complete a valid header line or bar
+    deadline: float = None  # the seconds the request may take, None for no limit
+    max_tokens: int = None  # the characters each tune may sample, None for no limit
+    evict_patches: int = 32  # the oldest bars evicted at once when max_patch goes beyond PATCH_LENGTH
+    exit_threshold: float = None  # the top char probability to exit the char-level decoder early at, None to run all layers
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            num_tunes=args.num_tunes,
+            max_patch=args.max_patch,
+            top_p=args.top_p,
+            top_k=args.top_k,
+            temperature=args.temperature,
+            seed=args.seed,
+            batch_size=args.batch_size,
+            num_draft=getattr(args, "num_draft", 0),
+            constrained=getattr(args, "constrained", False),
+            deadline=getattr(args, "deadline", None),
+            max_tokens=getattr(args, "max_tokens", None),
+            exit_threshold=getattr(args, "exit_threshold", None),
+        )
+
+
+@dataclass
+class GeneratedTune:
+    """
+    A generated tune, its bars exclude the prompt.
+    """
+
+    bars: list = field(default_factory=list)
+    patches: torch.Tensor = None
+    truncated: bool = False  # ended after its last complete bar by the deadline or token budget
+
+
+@dataclass
+class BarEvent:
+    """
+    A bar yielded by GenerationEngine.stream as soon as its patch is sampled.
+    """
+
+    tune: int  # the index of the tune in the request
+    index: int  # the index of the bar in the tune, excluding the prompt
+    bar: str
+    num_tokens: int  # the number of tokens sampled for the bar, including eos
+    step_time: float  # the seconds spent on the decode step that produced the bar
+    elapsed: float = 0  # the seconds since the request started
+
+
+def build_model(share_weights=SHARE_WEIGHTS, num_char_heads=0, char_exits=False):
+    patch_config = GPT2Config(
+        num_hidden_layers=PATCH_NUM_LAYERS,
+        n_embd=HIDDEN_SIZE,
+        n_head=NUM_HEADS,
+        layer_norm_epsilon=LAYER_NORM_EPS,
+        max_length=PATCH_LENGTH,
+        max_position_embeddings=PATCH_LENGTH,
+        vocab_size=1,
+    )
+    char_config = GPT2Config(
+        num_hidden_layers=CHAR_NUM_LAYERS,
+        n_embd=HIDDEN_SIZE,
+        n_head=NUM_HEADS,
+        layer_norm_epsilon=LAYER_NORM_EPS,
+        max_length=PATCH_SIZE,
+        max_position_embeddings=PATCH_SIZE,
+        vocab_size=128,
+    )
+    return TunesFormer(
+        patch_config,
+        char_config,
+        share_weights=share_weights,
+        num_char_heads=num_char_heads,
+        char_exits=char_exits,
+    )
+
+
+def count_char_heads(state_dict: dict):
+    """
+    The number of extra char-level heads saved in a checkpoint, 0 for checkpoints without them.
+    """
+    prefix = "char_level_decoder.heads."
+    return len({key[len(prefix) :].split(".")[0] for key in state_dict if key.startswith(prefix)})
+
+
+def load_model(weights: str, device=DEVICE, precision="fp32"):
+    checkpoint = torch.load(weights, weights_only=False)
+    model = build_model(
+        num_char_heads=count_char_heads(checkpoint["model"]),
+        char_exits=any(key.startswith("char_level_decoder.exits.") for key in checkpoint["model"]),
+    )
+    model.load_state_dict(checkpoint["model"], strict=False)
+    model = model.to(device)
+    model.eval()
+    return convert_precision(model, precision)
+
+
+def render_tune(tune: str, bars: list, show_control_code=False):
+    """
+    Join the header and the generated bars of a tune, hiding control codes if required.
+    :param tune: the header of the tune, ending with the prompt
+    :param bars: the generated bars
+    :param show_control_code: whether to keep the S:, B: and E: control codes
+    :return: the tune
+    """
+    lines = re.split(r"(\n)", tune)
+    tune = ""
+    skip = False
+    for line in lines:
+        if show_control_code or line[:2] not in ["S:", "B:", "E:"]:
+            if not skip:
+                tune += line
+
+            skip = False
+
+        else:
+            skip = True
+
+    for bar in bars:
+        if show_control_code or bar[:2] not in ["S:", "B:", "E:"]:
+            tune += bar
+
+    return tune
+
+
+class GenerationEngine:
+    """
+    Generates tunes with a loaded TunesFormer under torch.inference_mode.
+    The CLI, the experiments and the PPO rollouts all decode through it.
+    """
+
+    def __init__(
+        self,
+        model: TunesFormer,
+        patchilizer: Patchilizer = None,
+        draft: NGramDraft = None,
+        backend=None,
+    ):
+        """
+        :param model: the model, None when decoding only through the backend
+        :param backend: decodes instead of the model when given, a CompiledTunesFormer or an OnnxTunesFormer
+        """
+        self.model = model
+        self.patchilizer = patchilizer if patchilizer != None else Patchilizer()
+        self.draft = draft
+        self.backend = backend
+        self.prefix_cache = PrefixCache()
+        self.num_drafted = 0
+        self.num_accepted = 0
+        self.exit_stats = ExitStats()
+
+    @classmethod
+    def from_weights(
+        cls,
+        weights: str,
+        device=DEVICE,
+        draft: NGramDraft = None,
+        precision="fp32",
+        compile_batch_sizes: tuple = None,
+    ):
+        """
+        Load an engine from a checkpoint.
+        :param precision: fp32, bf16 to cast the GPT-2 blocks to bfloat16, or int8 to quantize them for CPU inference
+        :param compile_batch_sizes: the batch sizes to compile the decode steps for at start-up, None to decode uncompiled
+        """
+        model = load_model(weights, device, precision)
+        backend = None
+        if compile_batch_sizes:
+            backend = CompiledTunesFormer(model, compile_batch_sizes)
+
+        return cls(model, draft=draft, backend=backend)
+
+    @classmethod
+    def from_onnx(cls, onnx_dir=f"{OUTPUT_PATH}/onnx"):
+        """
+        Load an engine decoding through onnxruntime from the graphs written by onnx_backend.export_onnx.
+        """
+        return cls(None, backend=OnnxTunesFormer(onnx_dir))
+
+    @property
+    def acceptance_rate(self):
+        """
+        The fraction of drafted characters accepted by speculative decoding so far.
+        """
+        return self.num_accepted / max(self.num_drafted, 1)
+
+    @property
+    def device(self):
+        return self.model.device if self.model != None else self.backend.device
+
+    def generate(self, prompt: str, params: GenerationParams = None):
+        """
+        Generate tunes from a prompt.
+        :param prompt: the prompt shared by all tunes
+        :param params: the generation parameters, tune i is seeded with params.seed + i
+        :return: the generated tunes
+        """
+        if params == None:
+            params = GenerationParams()
+
+        deadline = request_deadline(params)
+        tunes = []
+        for seeds in batch_seeds(params):
+            state = GenerationState(
+                self.patchilizer, prompt, len(seeds), params.max_patch, self.device
+            )
+            for _ in self.decode(state, params, seeds, deadline):
+                pass
+
+            for j in range(len(seeds)):
+                tunes.append(
+                    GeneratedTune(
+                        bars=state.bars(j),
+                        patches=state.patches[j, : state.lengths[j]].clone(),
+                        truncated=state.truncated[j],
+                    )
+                )
+
+        return tunes
+
+    def stream(self, prompt: str, params: GenerationParams = None):
+        """
+        Generate tunes from a prompt, yielding each bar as soon as its patch is sampled.
+        :param prompt: the prompt shared by all tunes
+        :param params: the generation parameters, tune i is seeded with params.seed + i
+        :return: an iterator of BarEvent
+        """
+        if params == None:
+            params = GenerationParams()
+
+        start_time = time.time()
+        deadline = request_deadline(params)
+        first_tune = 0
+        for seeds in batch_seeds(params):
+            state = GenerationState(
+                self.patchilizer, prompt, len(seeds), params.max_patch, self.device
+            )
+            for event in self.decode(state, params, seeds, deadline, stream=True):
+                event.tune += first_tune
+                event.elapsed = time.time() - start_time
+                yield event
+
+            first_tune += len(seeds)
+
+    async def astream(self, prompt: str, params: GenerationParams = None):
+        """
+        The async version of stream, each decode step runs in a worker thread.
+        """
+        events = self.stream(prompt, params)
+        while True:
+            event = await asyncio.to_thread(next, events, None)
+            if event == None:
+                break
+
+            yield event
+
+    @torch.inference_mode()
+    def decode(
+        self,
+        state: GenerationState,
+        params: GenerationParams,
+        seeds: list,
+        deadline: float = None,
+        stream: bool = False,
+    ):
+        """
+        Decode a batch of tunes from the same prompt together, bar by bar.
+        Tunes out of time or tokens are truncated between two steps, so they always end with a complete bar.
+        Beyond PATCH_LENGTH patches, the patch-level window slides over the bars while the header stays pinned.
+        :param state: the generation state the patches are written into
+        :param seeds: the seed of each tune, a tune generates the same bars with the same seed whatever the batch size
+        :param deadline: the time.time() the request must end by, see request_deadline
+        :param stream: whether to decode the bars into BarEvent as they are sampled, otherwise nothing is yielded
+        :return: an iterator of BarEvent, the tunes are indexed within the batch
+        """
+        random_states = [RandomState(seed, self.device) for seed in seeds]
+        # without an n-gram draft, the extra char-level heads of the model draft if it has any
+        speculative = (
+            params.num_draft > 0
+            and self.model != None
+            and (self.draft != None or len(self.model.char_level_decoder.heads) > 0)
+        )
+        # early exit decodes through the torch model, after speculative decoding
+        early_exit = params.exit_threshold != None and self.model != None and not speculative
+        exit_kwargs = {}
+        if early_exit:
+            exit_kwargs = {"exit_threshold": params.exit_threshold, "exit_stats": self.exit_stats}
+
+        if self.backend != None and not speculative and not early_exit:
+            model = self.backend
+            past_key_values = self.backend.new_cache(len(seeds))
+
+        else:
+            model = self.model
+            past_key_values = DynamicCache()
+
+        # only the torch model starts from the cached prompt state, the backends encode the prompt
+        first_step = {}
+        if model is self.model and not speculative:
+            prefix = self.prefix_cache.get(
+                state.prompt,
+                lambda: self.model.encode_prefix(
+                    state.patches[:1, : state.prompt_length], state.next_tokens()[:1]
+                ),
+            )
+            past_key_values = repeat_cache(prefix.patch_key_values, len(seeds))
+            state.num_encoded = state.prompt_length
+            first_step = {"prefix": prefix}
+
+        step_time = 0
+        while state.active and state.num_patches < params.max_patch:
+            exhausted = exhausted_rows(state, params, deadline, step_time)
+            if exhausted:
+                kept = state.truncate(exhausted)
+                if not kept:
+                    break
+
+                past_key_values.batch_select_indices(torch.tensor(kept, device=self.device))
+
+            if state.num_positions > PATCH_LENGTH:
+                state.slide_window(params.evict_patches)
+                past_key_values.crop(state.num_pinned)
+
+            step_start = time.time()
+            # only a patch that starts a line may be a header line
+            line_starts = state.line_starts() if params.constrained else None
+            if speculative:
+                generated, (drafted, accepted) = (
+                    self.model.generate_speculative(
+                        state.new_patches(),
+                        state.next_tokens(),
+                        self.draft,
+                        num_draft=params.num_draft,
+                        top_p=params.top_p,
+                        top_k=params.top_k,
+                        temperature=params.temperature,
+                        random_states=[random_states[i] for i in state.active],
+                        past_key_values=past_key_values,
+                        constrained=params.constrained,
+                        line_starts=line_starts,
+                    )
+                )
+                self.num_drafted += drafted
+                self.num_accepted += accepted
+
+            else:
+                generated = model.generate_batch(
+                    state.new_patches(),
+                    state.next_tokens(),
+                    top_p=params.top_p,
+                    top_k=params.top_k,
+                    temperature=params.temperature,
+                    random_states=[random_states[i] for i in state.active],
+                    past_key_values=past_key_values,
+                    constrained=params.constrained,
+                    line_starts=line_starts,
+                    **first_step,
+                    **exit_kwargs,
+                )
+                first_step = {}
+
+            num_active = len(state.active)
+            kept = state.commit(generated)
+            if kept and len(kept) < num_active:
+                past_key_values.batch_select_indices(
+                    torch.tensor(kept, device=self.device)
+                )
+
+            step_time = time.time() - step_start
+            if not stream:
+                continue
+
+            for i in state.active:
+                index = state.lengths[i] - state.prompt_length - 1
+                yield BarEvent(
+                    tune=i,
+                    index=index,
+                    bar=state.bar(i, index),
+                    num_tokens=state.num_sampled[i],
+                    step_time=step_time,
+                )
+
+
+def request_deadline(params: GenerationParams):
+    """
+    The time.time() a request started now must end by, None without a deadline.
+    """
+    return None if params.deadline == None else time.time() + params.deadline
+
+
+def exhausted_rows(
+    state: GenerationState,
+    params: GenerationParams,
+    deadline: float = None,
+    step_time: float = 0,
+) -> list:
+    """
+    The rows of the active tunes to truncate before the next decode step:
+    all of them when the step, expected to last as long as the previous one, would end after the deadline,
+    otherwise those that sampled their token budget.
+    """
+    if deadline != None and time.time() + step_time > deadline:
+        return list(range(len(state.active)))
+
+    if params.max_tokens == None:
+        return []
+
+    return [
+        row
+        for row, i in enumerate(state.active)
+        if state.total_sampled[i] >= params.max_tokens
+    ]
+
+
+def batch_seeds(params: GenerationParams):
+    """
+    Split the tunes of a request into batches.
+    :return: an iterator of the seeds of each batch
+    """
+    for i in range(0, params.num_tunes, params.batch_size):
+        batch_size = min(params.batch_size, params.num_tunes - i)
+        yield [
+            None if params.seed == None else params.seed + i + j
+            for j in range(batch_size)
+        ]
+
+
+class PrefixCache:
+    """
+    An LRU cache of the PrefixState of the prompts an engine decoded from.
+    Each engine keeps its own, so the states are keyed by checkpoint and prompt.
+    The least recently used states are evicted once they exceed the memory budget.
+    """
+
+    def __init__(self, max_bytes=PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prompt: str, encode_prefix) -> PrefixState:
+        """
+        Get the state of a prompt, encoding it on a miss.
+        :param encode_prefix: a function returning the PrefixState of the prompt
+        """
+        with self.lock:
+            if prompt in self.states:
+                self.hits += 1
+                self.states.move_to_end(prompt)
+                return self.states[prompt]
+
+        prefix = encode_prefix()
+        with self.lock:
+            self.misses += 1
+            self.states[prompt] = prefix
+            self.states.move_to_end(prompt)
+            while len(self.states) > 1 and self.nbytes() > self.max_bytes:
+                self.states.popitem(last=False)
+
+            return prefix
+
+    def nbytes(self):
+        return sum(prefix.nbytes() for prefix in self.states.values())
+
+    def clear(self):
+        with self.lock:
+            self.states.clear()
+
+
+class ModelCache:
+    """
+    A process-wide LRU cache of generation engines keyed by weights path, device and precision.
+    The least recently used engines are evicted once their weights exceed the memory budget,
+    the most recent one is always kept.
+    """
+
+    def __init__(self, max_bytes=MODEL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.engines = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, weights: str, device=DEVICE, precision="fp32") -> GenerationEngine:
+        """
+        Get the engine of a checkpoint, loading it on a miss.
+        """
+        key = (os.path.abspath(weights), str(device), precision)
+        with self.lock:
+            if key in self.engines:
+                self.hits += 1
+                self.engines.move_to_end(key)
+                return self.engines[key]
+
+        engine = GenerationEngine.from_weights(weights, device, precision=precision)
+        with self.lock:
+            self.misses += 1
+            self.engines[key] = engine
+            self.sizes[key] = model_nbytes(engine.model)
+            self.engines.move_to_end(key)
+            self.evict()
+            return self.engines[key]
+
+    def nbytes(self):
+        return sum(self.sizes[key] for key in self.engines)
+
+    def evict(self):
+        while len(self.engines) > 1 and self.nbytes() > self.max_bytes:
+            key, _ = self.engines.popitem(last=False)
+            del self.sizes[key]
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self.lock:
+            self.engines.clear()
+            self.sizes.clear()
+
+
+def model_nbytes(model: torch.nn.Module):
+    """
+    The memory taken by the weights of a model, including quantized packed weights.
+    """
+    tensors = {}
+
+    def collect(value):
+        if isinstance(value, torch.Tensor):
+            tensors[value.data_ptr()] = value.numel() * value.element_size()
+
+        elif isinstance(value, (tuple, list)):
+            for item in value:
+                collect(item)
+
+    for value in model.state_dict().values():
+        collect(value)
+
+    return sum(tensors.values())
+
+
+MODEL_CACHE = ModelCache()
@@ -1,11 +1,10 @@
-import re
 import os
 import time
 import argparse
-import torch
-import torch.nn as nn
-from transformers import GPT2Config
-from utils import Patchilizer, TunesFormer, DEVICE
+from utils import Patchilizer, TunesFormer
+from engine import GenerationEngine, GenerationParams, render_tune
+from speculative import NGramDraft
+from precision import PRECISIONS
 from config import *
 
 
@@ -41,12 +40,79 @@ def get_args(parser):
         help="the temperature of the sampling operation",
     )
     parser.add_argument("-seed", type=int, default=None, help="seed for randomstate")
+    parser.add_argument(
+        "-batch_size",
+        type=int,
+        default=1,
+        help="the number of tunes generated together in one batch",
+    )
+    parser.add_argument(
+        "-constrained",
+        type=bool,
+        default=False,
+        help="whether to mask the characters that can never complete a valid header line or bar",
+    )
+    parser.add_argument(
+        "-deadline",
+        type=float,
+        default=None,
+        help="the seconds the generation may take, the tunes end after their last complete bar",
+    )
+    parser.add_argument(
+        "-max_tokens",
+        type=int,
+        default=None,
+        help="the characters each tune may sample, the tunes end after their last complete bar",
+    )
     parser.add_argument(
         "-show_control_code",
         type=bool,
         default=False,
         help="whether to show control code",
     )
+    parser.add_argument(
+        "-stream",
+        type=bool,
+        default=False,
+        help="whether to print each bar as soon as it is generated",
+    )
+    parser.add_argument(
+        "-draft",
+        type=str,
+        default=None,
+        help="the n-gram draft built by speculative.py for speculative decoding, the heads_weights.pth written by train.py -heads draft without it",
+    )
+    parser.add_argument(
+        "-num_draft",
+        type=int,
+        default=0,
+        help="the number of characters drafted per forward of speculative decoding, 0 disables it",
+    )
+    parser.add_argument(
+        "-exit_threshold",
+        type=float,
+        default=None,
+        help="the top character probability to exit the char-level decoder early at, None to run all its layers",
+    )
+    parser.add_argument(
+        "-precision",
+        type=str,
+        default="fp32",
+        choices=PRECISIONS,
+        help="fp32, bf16 to run the GPT-2 blocks in bfloat16, or int8 to quantize them for CPU inference",
+    )
+    parser.add_argument(
+        "-compile",
+        type=bool,
+        default=False,
+        help="whether to compile the decode steps with torch.compile at start-up",
+    )
+    parser.add_argument(
+        "-onnx_dir",
+        type=str,
+        default=None,
+        help="the graphs exported by onnx_backend.py, decodes through onnxruntime instead of the weights",
+    )
     parser.add_argument(
         "-weights",
         type=str,
@@ -54,36 +120,28 @@ def get_args(parser):
         help="weights path",
     )
     args = parser.parse_args()
+    if args.stream and args.batch_size > 1:
+        # the bars of a batch arrive interleaved across its tunes
+        parser.error("-stream prints one tune at a time, it requires -batch_size 1")
+
     return args
 
 
 def generate_abc(args):
-    patchilizer = Patchilizer()
-    patch_config = GPT2Config(
-        num_hidden_layers=PATCH_NUM_LAYERS,
-        max_length=PATCH_LENGTH,
-        max_position_embeddings=PATCH_LENGTH,
-        vocab_size=1,
-    )
-    char_config = GPT2Config(
-        num_hidden_layers=CHAR_NUM_LAYERS,
-        max_length=PATCH_SIZE,
-        max_position_embeddings=PATCH_SIZE,
-        vocab_size=128,
-    )
-    model: nn.Module = TunesFormer(patch_config, char_config, SHARE_WEIGHTS)
-    checkpoint = torch.load(args.weights, weights_only=False)
-    model.load_state_dict(checkpoint["model"], strict=False)
-    model = model.to(DEVICE)
-    model.eval()
+    draft = NGramDraft.load(args.draft) if args.draft else None
+    if args.onnx_dir:
+        engine = GenerationEngine.from_onnx(args.onnx_dir)
+
+    else:
+        engine = GenerationEngine.from_weights(
+            args.weights,
+            draft=draft,
+            precision=args.precision,
+            compile_batch_sizes=(args.batch_size,) if args.compile else None,
+        )
+
     prompt = 'A:Q1\nS:2\nB:9\nE:4\nB:9\nL:1/8\nM:3/4\nK:D\n de |"D" '
     tunes = ""
-    num_tunes = args.num_tunes
-    max_patch = args.max_patch
-    top_p = args.top_p
-    top_k = args.top_k
-    temperature = args.temperature
-    seed = args.seed
     show_control_code = args.show_control_code
     print(" Hyper params ".center(60, "#"), "\n")
     arg_dict: dict = vars(args)
@@ -92,71 +150,40 @@ def generate_abc(args):
 
     print("\n", " Output tunes ".center(60, "#"))
     start_time = time.time()
-    for i in range(num_tunes):
-        tune = f"X:{str(i + 1)}\n{prompt}"
-        lines = re.split(r"(\n)", tune)
-        tune = ""
-        skip = False
-        for line in lines:
-            if show_control_code or line[:2] not in ["S:", "B:", "E:"]:
-                if not skip:
-                    print(line, end="")
-                    tune += line
-
-                skip = False
-
-            else:
-                skip = True
-
-        input_patches = torch.tensor(
-            [patchilizer.encode(prompt, add_special_patches=True)[:-1]], device=DEVICE
-        )
-        if tune == "":
-            tokens = None
-
-        else:
-            prefix = patchilizer.decode(input_patches[0])
-            remaining_tokens = prompt[len(prefix) :]
-            tokens = torch.tensor(
-                [patchilizer.bos_token_id] + [ord(c) for c in remaining_tokens],
-                device=DEVICE,
-            )
-
-        while input_patches.shape[1] < max_patch:
-            predicted_patch, seed = model.generate(
-                input_patches,
-                tokens,
-                top_p=top_p,
-                top_k=top_k,
-                temperature=temperature,
-                seed=seed,
-            )
-            tokens = None
-            if predicted_patch[0] != patchilizer.eos_token_id:
-                next_bar = patchilizer.decode([predicted_patch])
-                if show_control_code or next_bar[:2] not in ["S:", "B:", "E:"]:
-                    print(next_bar, end="")
-                    tune += next_bar
-
-                if next_bar == "":
-                    break
-
-                next_bar = remaining_tokens + next_bar
-                remaining_tokens = ""
-                predicted_patch = torch.tensor(
-                    patchilizer.bar2patch(next_bar), device=DEVICE
-                ).unsqueeze(0)
-                input_patches = torch.cat(
-                    [input_patches, predicted_patch.unsqueeze(0)], dim=1
+    params = GenerationParams.from_args(args)
+    tune_bars = [[] for _ in range(params.num_tunes)]
+    for event in engine.stream(prompt, params):
+        tune_bars[event.tune].append(event.bar)
+        if args.stream:
+            if event.index == 0:
+                header = render_tune(
+                    f"X:{str(event.tune + 1)}\n{prompt}", [], show_control_code
                 )
+                print(f"\n{header}", end="")
+
+            print(render_tune("", [event.bar], show_control_code), end="", flush=True)
 
-            else:
-                break
+    for i, bars in enumerate(tune_bars):
+        tune = render_tune(f"X:{str(i + 1)}\n{prompt}", bars, show_control_code)
+        if not args.stream:
+            print(tune, end="\n\n")
 
         tunes += f"{tune}\n\n"
+
+    if args.stream:
         print("\n")
 
     print("Generation time: {:.2f} seconds".format(time.time() - start_time))
+    if engine.num_drafted:
+        print("Draft acceptance rate: {:.2%}".format(engine.acceptance_rate))
+
+    if engine.exit_stats.num_tokens:
+        print(
+            "Average char-level layers per token: {:.2f} of {}".format(
+                engine.exit_stats.average_layers, CHAR_NUM_LAYERS
+            )
+        )
+
     timestamp = time.strftime("%a_%d_%b_%Y_%H_%M_%S", time.localtime())
     os.makedirs(OUTPUT_PATH, exist_ok=True)
     with open(f"{OUTPUT_PATH}/{timestamp}.abc", "w") as f:
@@ -164,78 +191,13 @@ def generate_abc(args):
 
 
 def infer_abc(prompt: str, patchilizer: Patchilizer, model: TunesFormer):
-    tunes = ""
-    num_tunes = 1
-    max_patch = 128
-    top_p = 0.8
-    top_k = 8
-    temperature = 1.2
-    seed = None
     show_control_code = False
-    for i in range(num_tunes):
-        tune = f"X:{str(i + 1)}\n{prompt}"
-        lines = re.split(r"(\n)", tune)
-        tune = ""
-        skip = False
-        for line in lines:
-            if show_control_code or line[:2] not in ["S:", "B:", "E:"]:
-                if not skip:
-                    print(line, end="")
-                    tune += line
-
-                skip = False
-
-            else:
-                skip = True
-
-        input_patches = torch.tensor(
-            [patchilizer.encode(prompt, add_special_patches=True)[:-1]], device=DEVICE
-        )
-        if tune == "":
-            tokens = None
-
-        else:
-            prefix = patchilizer.decode(input_patches[0])
-            remaining_tokens = prompt[len(prefix) :]
-            tokens = torch.tensor(
-                [patchilizer.bos_token_id] + [ord(c) for c in remaining_tokens],
-                device=DEVICE,
-            )
-
-        while input_patches.shape[1] < max_patch:
-            predicted_patch, seed = model.generate(
-                input_patches,
-                tokens,
-                top_p=top_p,
-                top_k=top_k,
-                temperature=temperature,
-                seed=seed,
-            )
-            tokens = None
-            if predicted_patch[0] != patchilizer.eos_token_id:
-                next_bar = patchilizer.decode([predicted_patch])
-                if show_control_code or next_bar[:2] not in ["S:", "B:", "E:"]:
-                    print(next_bar, end="")
-                    tune += next_bar
-
-                if next_bar == "":
-                    break
-
-                next_bar = remaining_tokens + next_bar
-                remaining_tokens = ""
-                predicted_patch = torch.tensor(
-                    patchilizer.bar2patch(next_bar), device=DEVICE
-                ).unsqueeze(0)
-                input_patches = torch.cat(
-                    [input_patches, predicted_patch.unsqueeze(0)], dim=1
-                )
-
-            else:
-                break
-
-        tunes += f"{tune}\n\n"
-
-    return tunes, input_patches
+    engine = GenerationEngine(model, patchilizer)
+    generated_tune = engine.generate(prompt)[0]
+    tune = render_tune(f"X:1\n{prompt}", generated_tune.bars, show_control_code)
+    print(tune, end="")
+    tunes = f"{tune}\n\n"
+    return tunes, generated_tune.patches.unsqueeze(0)
 
 
 if __name__ == "__main__":
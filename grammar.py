@@ -0,0 +1,156 @@
+from functools import lru_cache
+import torch
+from config import *
+
+HEADER_FIELDS = "ABCDEFGHIKLMNOPQRSTUVWXZmrsw"  # the letters of the ABC information fields
+VOCAB_SIZE = 128
+EOS_TOKEN_ID = 2
+
+# the state of a patch: (number of characters, kind, inside "...", inside !...!, inside [...], inside {...}, header line ended, last character)
+# kind is "" before the first character of a patch that starts a line, "field" after a field letter that may start a header line,
+# "letter" after another letter, "header" right after the colon of a header line, "value" in the value of a header line
+# or of a % line, and "bar" otherwise
+START_STATE = (0, "", False, False, False, False, False, "")
+# a patch that continues a line of the body is a bar, whatever it starts with
+BAR_STATE = (0, "bar", False, False, False, False, False, "")
+
+
+def num_closing(state: tuple) -> int:
+    """
+    The number of characters the patch needs at least before it may end.
+    """
+    _, kind, quote, decoration, chord, grace, ended, _ = state
+    if kind == "header":
+        return 2
+
+    if kind == "value" and not ended:
+        return 1
+
+    return quote + decoration + chord + grace
+
+
+def transition(state: tuple, char: str):
+    """
+    Read a character of a patch.
+    :return: the next state and whether the character can still lead to a valid header line or bar
+    """
+    length, kind, quote, decoration, chord, grace, ended, previous = state
+    valid = not ended and (char == "\n" or " " <= char <= "~")
+    if kind in ("header", "value"):
+        valid &= kind == "value" or char != "\n"
+        kind = "value"
+
+    elif char == "\n":
+        # the lines of the body break anywhere between the groups of a bar, also right at its start
+        valid &= not (quote or decoration or chord or grace)
+        kind = "bar"
+
+    elif quote:
+        quote = char != '"'
+
+    elif decoration:
+        decoration = char != "!"
+
+    elif kind in ("field", "letter") and char == ":":
+        valid &= kind == "field"
+        kind = "header"
+
+    elif kind == "" and char == "%":
+        # a comment or a directive such as %%score takes its whole line, like a header line
+        kind = "value"
+
+    else:
+        if char == '"':
+            quote = True
+
+        elif char == "!":
+            decoration = True
+
+        elif char == "[":
+            valid &= not (chord or grace)
+            chord = True
+
+        elif char == "]":
+            # a chord or inline field closes, or the |] bar line
+            valid &= chord or previous == "|"
+            chord = False
+
+        elif char == "|":
+            # only the [| bar line may sit inside brackets
+            valid &= not grace and (not chord or previous == "[")
+            chord = False
+
+        elif char == "{":
+            valid &= not (chord or grace)
+            grace = True
+
+        elif char == "}":
+            valid &= grace
+            grace = False
+
+        if kind == "" and char.isalpha():
+            kind = "field" if char in HEADER_FIELDS else "letter"
+
+        else:
+            kind = "bar"
+
+    # only a header line ends with its newline
+    ended = ended or (kind == "value" and char == "\n")
+    next_state = (length + 1, kind, quote, decoration, chord, grace, ended, char)
+    return next_state, valid
+
+
+@lru_cache(maxsize=None)
+def allowed_tokens(state: tuple, patch_size=PATCH_SIZE) -> torch.Tensor:
+    """
+    The tokens that keep a patch completable within its size, eos included once it can end.
+    """
+    mask = torch.zeros(VOCAB_SIZE, dtype=torch.bool)
+    # bos, the characters and eos
+    capacity = patch_size - 2
+    for token in range(EOS_TOKEN_ID + 1, VOCAB_SIZE):
+        next_state, valid = transition(state, chr(token))
+        mask[token] = valid and next_state[0] + num_closing(next_state) <= capacity
+
+    mask[EOS_TOKEN_ID] = state[0] > 0 and num_closing(state) == 0
+    if state[1] == "value":
+        # a header line ends with its newline
+        mask[EOS_TOKEN_ID] &= state[6]
+
+    return mask
+
+
+class AbcAutomaton:
+    """
+    An incremental automaton over the characters of a patch, either a header line, a % line or a bar of ABC notation.
+    It masks the tokens that can never complete a valid patch: control characters, unbalanced chords,
+    chord symbols, decorations and grace notes, bar lines inside them, unknown header fields,
+    and anything left open when the patch runs out of room.
+    """
+
+    def __init__(self, tokens: list = [], patch_size=PATCH_SIZE, line_start=True):
+        """
+        :param tokens: the characters the patch starts with, they are read without being checked
+        :param line_start: whether the patch starts a line, only then it may be a header line or a % line
+        """
+        self.patch_size = patch_size
+        self.state = START_STATE if line_start else BAR_STATE
+        for token in tokens:
+            self.advance(token)
+
+    def advance(self, token: int):
+        if token > EOS_TOKEN_ID:
+            self.state, _ = transition(self.state, chr(token))
+
+    def mask(self) -> torch.Tensor:
+        return allowed_tokens(self.state, self.patch_size)
+
+
+def mask_probs(probs: torch.Tensor, automata: list) -> torch.Tensor:
+    """
+    Zero the probabilities of the tokens each sequence's automaton rules out.
+    A sequence whose allowed tokens all have zero probability draws uniformly among them.
+    """
+    masks = torch.stack([automaton.mask() for automaton in automata]).to(probs.device)
+    probs = probs * masks
+    return torch.where(probs.sum(dim=-1, keepdim=True) > 0, probs, masks.to(probs.dtype))
@@ -1,16 +1,19 @@
 import re
 import os
+import math
 import time
-import torch
+import uuid
 import random
 import shutil
 import argparse
 import warnings
 import subprocess
 import soundfile as sf
-from utils import Patchilizer, TunesFormer, DEVICE, MSCORE
+from dataclasses import dataclass, field
+from utils import MSCORE
+from engine import GenerationParams, MODEL_CACHE, render_tune
+from pool import WorkerPool
 from modelscope import snapshot_download
-from transformers import GPT2Config
 from music21 import converter, interval, clef, stream
 from config import *
 
@@ -49,12 +52,48 @@ def get_args(parser: argparse.ArgumentParser):
         help="the temperature of the sampling operation",
     )
     parser.add_argument("-seed", type=int, default=None, help="seed for randomstate")
+    parser.add_argument(
+        "-batch_size",
+        type=int,
+        default=1,
+        help="the number of tunes generated together in one batch",
+    )
+    parser.add_argument(
+        "-constrained",
+        type=bool,
+        default=False,
+        help="whether to mask the characters that can never complete a valid header line or bar",
+    )
     parser.add_argument(
         "-show_control_code",
         type=bool,
         default=False,
         help="whether to show control code",
     )
+    parser.add_argument(
+        "-num_workers",
+        type=int,
+        default=1,
+        help="the number of generation processes of the experiments, 1 to generate in this process",
+    )
+    parser.add_argument(
+        "-num_threads",
+        type=int,
+        default=None,
+        help="the torch threads of each generation process, by default its share of the cores",
+    )
+    parser.add_argument(
+        "-pin_cores",
+        type=bool,
+        default=False,
+        help="whether to pin each generation process to its own cores",
+    )
+    parser.add_argument(
+        "-prefork",
+        type=bool,
+        default=False,
+        help="whether to load the models once and fork the generation processes to share their weights",
+    )
     return parser.parse_args()
 
 
@@ -118,44 +157,17 @@ def adjust_volume(in_audio: str, dB_change: int):
     sf.write(in_audio, y * 10 ** (dB_change / 20), sr)
 
 
-def generate_music(
+def compose_tunes(
     args,
     emo: str,
     weights: str,
-    outdir=TEMP_DIR,
     fix_tempo=True,
     fix_mode=True,
-    fix_pitch=True,
     fix_std=True,
-    fix_volume=True,
-    clean_score=False,
 ):
-    patchilizer = Patchilizer()
-    patch_config = GPT2Config(
-        num_hidden_layers=PATCH_NUM_LAYERS,
-        max_length=PATCH_LENGTH,
-        max_position_embeddings=PATCH_LENGTH,
-        vocab_size=1,
-    )
-    char_config = GPT2Config(
-        num_hidden_layers=CHAR_NUM_LAYERS,
-        max_length=PATCH_SIZE,
-        max_position_embeddings=PATCH_SIZE,
-        vocab_size=128,
-    )
-    model = TunesFormer(patch_config, char_config, share_weights=SHARE_WEIGHTS)
-    checkpoint = torch.load(weights, weights_only=False)
-    model.load_state_dict(checkpoint["model"], strict=False)
-    model = model.to(DEVICE)
-    model.eval()
+    engine = MODEL_CACHE.get(weights)
     prompt = ""
     tunes = ""
-    num_tunes = args.num_tunes
-    max_patch = args.max_patch
-    top_p = args.top_p
-    top_k = args.top_k
-    temperature = args.temperature
-    seed = args.seed
     show_control_code = args.show_control_code
     print(" Hyper parms ".center(60, "#"), "\n")
     args_dict: dict = vars(args)
@@ -182,74 +194,17 @@ def generate_music(
 
     print("\n", " Output tunes ".center(60, "#"))
     start_time = time.time()
-    for i in range(num_tunes):
-        title = f"T:{emo} Fragment\n"
-        artist = f"C:Generated by AI\n"
-        tune = f"X:{str(i + 1)}\n{title}{artist}{prompt}"
-        lines = re.split(r"(\n)", tune)
-        tune = ""
-        skip = False
-        for line in lines:
-            if show_control_code or line[:2] not in ["S:", "B:", "E:"]:
-                if not skip:
-                    print(line, end="")
-                    tune += line
-
-                skip = False
-
-            else:
-                skip = True
-
-        input_patches = torch.tensor(
-            [patchilizer.encode(prompt, add_special_patches=True)[:-1]],
-            device=DEVICE,
+    title = f"T:{emo} Fragment\n"
+    artist = f"C:Generated by AI\n"
+    generated_tunes = engine.generate(prompt, GenerationParams.from_args(args))
+    for i, generated_tune in enumerate(generated_tunes):
+        tune = render_tune(
+            f"X:{str(i + 1)}\n{title}{artist}{prompt}",
+            generated_tune.bars,
+            show_control_code,
         )
-        if tune == "":
-            tokens = None
-
-        else:
-            prefix = patchilizer.decode(input_patches[0])
-            remaining_tokens = prompt[len(prefix) :]
-            tokens = torch.tensor(
-                [patchilizer.bos_token_id] + [ord(c) for c in remaining_tokens],
-                device=DEVICE,
-            )
-
-        while input_patches.shape[1] < max_patch:
-            predicted_patch, seed = model.generate(
-                input_patches,
-                tokens,
-                top_p=top_p,
-                top_k=top_k,
-                temperature=temperature,
-                seed=seed,
-            )
-            tokens = None
-            if predicted_patch[0] != patchilizer.eos_token_id:
-                next_bar = patchilizer.decode([predicted_patch])
-                if show_control_code or next_bar[:2] not in ["S:", "B:", "E:"]:
-                    print(next_bar, end="")
-                    tune += next_bar
-
-                if next_bar == "":
-                    break
-
-                next_bar = remaining_tokens + next_bar
-                remaining_tokens = ""
-                predicted_patch = torch.tensor(
-                    patchilizer.bar2patch(next_bar),
-                    device=DEVICE,
-                ).unsqueeze(0)
-                input_patches = torch.cat(
-                    [input_patches, predicted_patch.unsqueeze(0)],
-                    dim=1,
-                )
-
-            else:
-                break
-
+        print(tune, end="\n\n")
         tunes += f"{tune}\n\n"
-        print("\n")
 
     # fix tempo
     tempo = ""
@@ -280,7 +235,28 @@ def generate_music(
             tunes = tunes.replace(f"\nK:{K_val}\n", f"\nK:{K_val.lower()}min\n")
 
     print("Generation time: {:.2f} seconds".format(time.time() - start_time))
-    timestamp = time.strftime("%a_%d_%b_%Y_%H_%M_%S", time.localtime())
+    return tunes
+
+
+def render_audio(
+    tunes: str,
+    emo: str,
+    outdir=TEMP_DIR,
+    fix_pitch=True,
+    fix_volume=True,
+    clean_score=False,
+    name: str = None,
+):
+    """
+    Render the tunes of compose_tunes to a wav file through MuseScore.
+    :param name: the file name without extension, by default a timestamp, unique names let processes share outdir
+    :return: the audio path, or an empty string when the tunes fail to render
+    """
+    title = f"T:{emo} Fragment\n"
+    mode = "major" if emo == "Q1" or emo == "Q4" else "minor"
+    if name == None:
+        name = time.strftime("%a_%d_%b_%Y_%H_%M_%S", time.localtime())
+
     try:
         # fix avg_pitch (octave)
         if mode == "minor" and fix_pitch:
@@ -290,15 +266,15 @@ def generate_music(
 
             tunes, xml = transpose_octaves_abc(
                 tunes,
-                f"{outdir}/{timestamp}.musicxml",
+                f"{outdir}/{name}.musicxml",
                 offset,
             )
             tunes = tunes.replace(title + title, title)
-            os.rename(xml, f"{outdir}/[{emo}]{timestamp}.musicxml")
-            xml = f"{outdir}/[{emo}]{timestamp}.musicxml"
+            os.rename(xml, f"{outdir}/[{emo}]{name}.musicxml")
+            xml = f"{outdir}/[{emo}]{name}.musicxml"
 
         else:
-            xml = abc2xml(tunes, f"{outdir}/[{emo}]{timestamp}.musicxml")
+            xml = abc2xml(tunes, f"{outdir}/[{emo}]{name}.musicxml")
 
         audio = xml2(xml, "wav")
         if os.path.exists(xml) and clean_score:
@@ -323,6 +299,73 @@ def generate_music(
         return ""
 
 
+def generate_music(
+    args,
+    emo: str,
+    weights: str,
+    outdir=TEMP_DIR,
+    fix_tempo=True,
+    fix_mode=True,
+    fix_pitch=True,
+    fix_std=True,
+    fix_volume=True,
+    clean_score=False,
+):
+    tunes = compose_tunes(args, emo, weights, fix_tempo, fix_mode, fix_std)
+    return render_audio(tunes, emo, outdir, fix_pitch, fix_volume, clean_score)
+
+
+@dataclass
+class GenerationJob:
+    """
+    One call of generate_music handed to a worker process.
+    """
+
+    emotion: str
+    args: argparse.Namespace
+    seed: int = None
+    weights: str = ""
+    outdir: str = TEMP_DIR
+    fixes: dict = field(default_factory=dict)  # the fix_* flags of generate_music
+
+
+@dataclass
+class GenerationResult:
+    emotion: str
+    seed: int
+    abc: str
+    audio: str  # empty when the tunes failed to render
+
+
+def run_job(job: GenerationJob) -> GenerationResult:
+    """
+    Generate and render the tunes of a job, in a worker process or in this one.
+    The seed of the job seeds both the tunes and the tempo and mode choices.
+    """
+    args = argparse.Namespace(**{**vars(job.args), "seed": job.seed})
+    if job.seed != None:
+        random.seed(job.seed)
+
+    fixes = job.fixes
+    abc = compose_tunes(
+        args,
+        job.emotion,
+        job.weights,
+        fixes.get("fix_tempo", True),
+        fixes.get("fix_mode", True),
+        fixes.get("fix_std", True),
+    )
+    audio = render_audio(
+        abc,
+        job.emotion,
+        job.outdir,
+        fixes.get("fix_pitch", True),
+        fixes.get("fix_volume", True),
+        name=f"{time.strftime('%a_%d_%b_%Y_%H_%M_%S', time.localtime())}_{uuid.uuid4().hex[:8]}",
+    )
+    return GenerationResult(job.emotion, job.seed, abc, audio)
+
+
 def infers(
     dataset: str,
     emotion: str,
@@ -355,6 +398,39 @@ def add_to_log(message: str, log_file_path=f"{EXPERIMENT_DIR}/success_rates.log"
         file.write(message + "\n")
 
 
+def run_trials(
+    dataset: str,
+    emotion: str,
+    outdir: str,
+    num_trials: int,
+    pool: WorkerPool = None,
+    start: int = 0,
+    **fixes,
+):
+    """
+    Generate num_trials tunes of an emotion, across the workers of a pool when given.
+    Trials are seeded from args.seed + start, so that retries draw new tunes.
+    :return: whether each trial rendered
+    """
+    if pool == None:
+        return [bool(infers(dataset, emotion, outdir, **fixes)) for _ in range(num_trials)]
+
+    os.makedirs(outdir, exist_ok=True)
+    args = get_args(argparse.ArgumentParser())
+    jobs = [
+        GenerationJob(
+            emotion,
+            args,
+            seed=None if args.seed == None else args.seed + start + i,
+            weights=f"{EMelodyGen_WEIGHTS_DIR}/{dataset.lower()}/weights.pth",
+            outdir=outdir,
+            fixes=fixes,
+        )
+        for i in range(num_trials)
+    ]
+    return [bool(result.audio) for result in pool.map(run_job, jobs)]
+
+
 def generate_exps(
     fix_t=True,
     fix_m=True,
@@ -363,6 +439,7 @@ def generate_exps(
     fix_v=True,
     total=100,
     labels=["Q1", "Q2", "Q3", "Q4"],
+    pool: WorkerPool = None,
 ):
     subdir = "none"
     if not fix_t:
@@ -382,30 +459,42 @@ def generate_exps(
 
     outdir = f"{EXPERIMENT_DIR}/{subdir}"
     hit_rate = []
+    fixes = dict(
+        fix_tempo=fix_t,
+        fix_mode=fix_m,
+        fix_pitch=fix_p,
+        fix_std=fix_s,
+        fix_volume=fix_v,
+    )
     for emo in labels:
         success, fail = 0, 0
         while success < total / len(labels):
-            if infers("Rough4Q", emo, outdir, fix_t, fix_m, fix_p, fix_s, fix_v):
-                success += 1
-            else:
-                fail += 1
+            # never more trials than the successes still missing, as when generating one by one
+            num_trials = math.ceil(total / len(labels) - success)
+            rendered = run_trials(
+                "Rough4Q", emo, outdir, num_trials, pool, start=success + fail, **fixes
+            )
+            success += sum(rendered)
+            fail += len(rendered) - sum(rendered)
 
         hit_rate.append(success / (success + fail))
 
     add_to_log(f"Rough4Q-{outdir.split('/')[-1]}: {sum(hit_rate) / len(hit_rate)}")
 
 
-def success_rate(total=100, subset="EMOPIA", labels=["Q1", "Q2", "Q3", "Q4"]):
+def success_rate(
+    total=100,
+    subset="EMOPIA",
+    labels=["Q1", "Q2", "Q3", "Q4"],
+    pool: WorkerPool = None,
+):
     hit_rate = []
     outdir = f"{EXPERIMENT_DIR}/{subset.lower()}"
     for emo in labels:
-        success, fail = 0, 0
-        while success + fail < total / len(labels):
-            if infers(subset, emo, outdir):
-                success += 1
-            else:
-                fail += 1
-
+        num_trials = math.ceil(total / len(labels))
+        rendered = run_trials(subset, emo, outdir, num_trials, pool)
+        success = sum(rendered)
+        fail = len(rendered) - success
         hit_rate.append(success / (success + fail))
 
     add_to_log(f"{subset}: {sum(hit_rate) / len(hit_rate)}")
@@ -416,12 +505,26 @@ if __name__ == "__main__":
     if os.path.exists(EXPERIMENT_DIR):
         shutil.rmtree(EXPERIMENT_DIR)
 
-    generate_exps()  # no ablation
-    generate_exps(fix_t=False)  # ablate tempo
-    generate_exps(fix_m=False)  # ablate mode
-    generate_exps(fix_p=False)  # ablate avg_pitch (octave)
-    generate_exps(fix_s=False)  # ablate pitch_std
-    generate_exps(fix_v=False)  # ablate volume
-
-    success_rate()  # calc render success rate for EMOPIA
-    success_rate(subset="VGMIDI")  # calc render success rate for VGMIDI
+    args = get_args(argparse.ArgumentParser())
+    pool = None
+    if args.num_workers > 1:
+        preload = None
+        if args.prefork:
+            preload = [
+                f"{EMelodyGen_WEIGHTS_DIR}/{dataset.lower()}/weights.pth"
+                for dataset in ("Rough4Q", "EMOPIA", "VGMIDI")
+            ]
+
+        pool = WorkerPool(args.num_workers, args.num_threads, args.pin_cores, preload)
+
+    generate_exps(pool=pool)  # no ablation
+    generate_exps(fix_t=False, pool=pool)  # ablate tempo
+    generate_exps(fix_m=False, pool=pool)  # ablate mode
+    generate_exps(fix_p=False, pool=pool)  # ablate avg_pitch (octave)
+    generate_exps(fix_s=False, pool=pool)  # ablate pitch_std
+    generate_exps(fix_v=False, pool=pool)  # ablate volume
+
+    success_rate(pool=pool)  # calc render success rate for EMOPIA
+    success_rate(subset="VGMIDI", pool=pool)  # calc render success rate for VGMIDI
+    if pool != None:
+        pool.close()
@@ -0,0 +1,494 @@
+import time
+import pickle
+import zipfile
+import argparse
+from collections import OrderedDict
+import numpy as np
+from patchilizer import Patchilizer
+from config import *
+
+STORAGE_DTYPES = {
+    "FloatStorage": np.float32,
+    "DoubleStorage": np.float64,
+    "HalfStorage": np.float16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+    "ShortStorage": np.int16,
+    "CharStorage": np.int8,
+    "ByteStorage": np.uint8,
+    "BoolStorage": np.bool_,
+}
+
+
+class LazyTensor:
+    """
+    A tensor of a torch checkpoint, read from the archive only when loaded.
+    """
+
+    def __init__(self, storage, offset: int, size: tuple, stride: tuple):
+        self.storage = storage
+        self.offset = offset
+        self.size = tuple(size)
+        self.stride = tuple(stride)
+
+    def load(self) -> np.ndarray:
+        data = self.storage()
+        itemsize = data.dtype.itemsize
+        return np.lib.stride_tricks.as_strided(
+            data[self.offset :],
+            shape=self.size,
+            strides=[s * itemsize for s in self.stride],
+        ).copy()
+
+
+def rebuild_tensor(storage, offset, size, stride, *args):
+    return LazyTensor(storage, offset, size, stride)
+
+
+def rebuild_parameter(tensor, *args):
+    return tensor
+
+
+CHECKPOINT_GLOBALS = {
+    ("collections", "OrderedDict"): OrderedDict,
+    ("torch._utils", "_rebuild_tensor_v2"): rebuild_tensor,
+    ("torch._utils", "_rebuild_parameter"): rebuild_parameter,
+}
+
+
+class CheckpointUnpickler(pickle.Unpickler):
+    """
+    Reads the zip checkpoints written by torch.save without torch, the tensors become LazyTensor.
+    Unlike pickle.Unpickler, it refuses any global other than those of a state dict.
+    """
+
+    def __init__(self, archive: zipfile.ZipFile, prefix: str):
+        super().__init__(archive.open(f"{prefix}/data.pkl"))
+        self.archive = archive
+        self.prefix = prefix
+
+    def find_class(self, module: str, name: str):
+        # only the globals of a state dict resolve, a checkpoint cannot import anything else
+        if (module, name) in CHECKPOINT_GLOBALS:
+            return CHECKPOINT_GLOBALS[module, name]
+
+        if module == "torch" and name in STORAGE_DTYPES:
+            return STORAGE_DTYPES[name]
+
+        raise pickle.UnpicklingError(f"Unsupported object {module}.{name} in checkpoint")
+
+    def persistent_load(self, pid):
+        _, dtype, key, _, _ = pid
+        path = f"{self.prefix}/data/{key}"
+        return lambda: np.frombuffer(self.archive.read(path), dtype)
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Load the model weights of a torch checkpoint of TunesFormer as float32 arrays.
+    """
+    with zipfile.ZipFile(path) as archive:
+        prefix = archive.namelist()[0].split("/")[0]
+        checkpoint = CheckpointUnpickler(archive, prefix).load()
+        return {
+            name: tensor.load().astype(np.float32)
+            for name, tensor in checkpoint["model"].items()
+        }
+
+
+def load_weights(path: str) -> dict:
+    """
+    Load the weights of a TunesFormer from a torch checkpoint or from the .npz written by export_npz.
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as weights:
+            return dict(weights)
+
+    return load_checkpoint(path)
+
+
+def export_npz(weights: str, path: str):
+    """
+    Write the model weights of a torch checkpoint to an uncompressed .npz, the fastest format to load.
+    """
+    np.savez(path, **load_checkpoint(weights))
+    return path
+
+
+def layer_norm(x: np.ndarray, weight: np.ndarray, bias: np.ndarray) -> np.ndarray:
+    mean = x.mean(-1, keepdims=True)
+    variance = ((x - mean) ** 2).mean(-1, keepdims=True)
+    return (x - mean) / np.sqrt(variance + np.float32(LAYER_NORM_EPS)) * weight + bias
+
+
+def gelu(x: np.ndarray) -> np.ndarray:
+    # the tanh approximation of gelu_new, the GPT-2 activation, kept in float32
+    scale = np.float32(np.sqrt(2 / np.pi))
+    return 0.5 * x * (1 + np.tanh(scale * (x + np.float32(0.044715) * x**3)))
+
+
+def softmax(x: np.ndarray) -> np.ndarray:
+    x = np.exp(x - x.max(-1, keepdims=True))
+    return x / x.sum(-1, keepdims=True)
+
+
+class NumpyGPT2:
+    """
+    The GPT-2 transformer of a decoder, over explicit key/value arrays.
+    """
+
+    def __init__(self, weights: dict, prefix: str):
+        self.wpe = weights[f"{prefix}.wpe.weight"]
+        self.ln_f = weights[f"{prefix}.ln_f.weight"], weights[f"{prefix}.ln_f.bias"]
+        self.blocks = []
+        while f"{prefix}.h.{len(self.blocks)}.ln_1.weight" in weights:
+            block = f"{prefix}.h.{len(self.blocks)}"
+            self.blocks.append(
+                {
+                    name: weights[f"{block}.{name}"]
+                    for name in (
+                        "ln_1.weight",
+                        "ln_1.bias",
+                        "attn.c_attn.weight",
+                        "attn.c_attn.bias",
+                        "attn.c_proj.weight",
+                        "attn.c_proj.bias",
+                        "ln_2.weight",
+                        "ln_2.bias",
+                        "mlp.c_fc.weight",
+                        "mlp.c_fc.bias",
+                        "mlp.c_proj.weight",
+                        "mlp.c_proj.bias",
+                    )
+                }
+            )
+
+    def empty_cache(self, batch_size: int) -> list:
+        head_dim = self.wpe.shape[1] // NUM_HEADS
+        return [
+            np.zeros((batch_size, NUM_HEADS, 0, head_dim), dtype=np.float32)
+            for _ in range(2 * len(self.blocks))
+        ]
+
+    def forward(self, inputs_embeds: np.ndarray, past_key_values: list):
+        """
+        :param inputs_embeds: the input embeddings in shape [batch, n, n_embd]
+        :param past_key_values: the keys and values of the layers in turn, each in shape [batch, heads, past, head_dim]
+        :return: the last hidden states and the keys and values including the new positions
+        """
+        batch_size, length, n_embd = inputs_embeds.shape
+        head_dim = n_embd // NUM_HEADS
+        past_length = past_key_values[0].shape[2]
+        positions = np.arange(past_length, past_length + length)
+        hidden_states = inputs_embeds + self.wpe[positions]
+        # each position attends to the positions up to itself
+        masked = np.arange(past_length + length) > positions[:, None]
+        present_key_values = []
+        for i, block in enumerate(self.blocks):
+            x = layer_norm(hidden_states, block["ln_1.weight"], block["ln_1.bias"])
+            x = x @ block["attn.c_attn.weight"] + block["attn.c_attn.bias"]
+            query, key, value = (
+                x.reshape(batch_size, length, NUM_HEADS, head_dim).transpose(0, 2, 1, 3)
+                for x in np.split(x, 3, axis=-1)
+            )
+            key = np.concatenate((past_key_values[2 * i], key), axis=2)
+            value = np.concatenate((past_key_values[2 * i + 1], value), axis=2)
+            present_key_values += [key, value]
+            scores = query @ key.transpose(0, 1, 3, 2) / np.float32(np.sqrt(head_dim))
+            scores = np.where(masked, np.float32(-np.inf), scores)
+            x = softmax(scores) @ value
+            x = x.transpose(0, 2, 1, 3).reshape(batch_size, length, n_embd)
+            hidden_states = hidden_states + x @ block["attn.c_proj.weight"] + block["attn.c_proj.bias"]
+            x = layer_norm(hidden_states, block["ln_2.weight"], block["ln_2.bias"])
+            x = gelu(x @ block["mlp.c_fc.weight"] + block["mlp.c_fc.bias"])
+            hidden_states = hidden_states + x @ block["mlp.c_proj.weight"] + block["mlp.c_proj.bias"]
+
+        return layer_norm(hidden_states, *self.ln_f), present_key_values
+
+
+def adjust_probs(
+    probs: np.ndarray,
+    top_p: float = 1,
+    top_k: int = 0,
+    temperature: float = 1,
+) -> np.ndarray:
+    """
+    The NumPy version of utils.adjust_probs.
+    :param probs: the probability distributions in shape [batch, vocab_size]
+    """
+    if 0 < top_p and top_p < 1:
+        sorted_tokens = np.argsort(-probs, axis=-1, kind="stable")
+        sorted_probs = np.take_along_axis(probs, sorted_tokens, -1)
+        tokens_to_remove = np.cumsum(sorted_probs, axis=-1) > top_p
+        # keep the token that crosses top_p
+        tokens_to_remove[:, 1:] = tokens_to_remove[:, :-1].copy()
+        tokens_to_remove[:, 0] = False
+        probs = np.zeros_like(probs)
+        np.put_along_axis(probs, sorted_tokens, sorted_probs * ~tokens_to_remove, -1)
+
+    if top_k > 0:
+        top_tokens = np.argsort(-probs, axis=-1, kind="stable")[:, :top_k]
+        top_probs = np.take_along_axis(probs, top_tokens, -1)
+        probs = np.zeros_like(probs)
+        np.put_along_axis(probs, top_tokens, top_probs, -1)
+
+    if temperature != 1:
+        probs = probs ** (1 / temperature)
+
+    return probs / probs.sum(-1, keepdims=True)
+
+
+class NumpyTunesFormer:
+    """
+    A NumPy-only runtime of TunesFormer, it starts without importing torch or transformers.
+    It computes the same distributions as the PyTorch decoders up to float rounding,
+    and samples each tune with its own numpy Generator, so its tunes differ from the torch ones for a seed.
+    """
+
+    def __init__(self, weights: dict):
+        self.patchilizer = Patchilizer()
+        self.patch_embedding = weights["patch_level_decoder.patch_embedding.weight"].T.copy()
+        self.patch_embedding_bias = weights["patch_level_decoder.patch_embedding.bias"]
+        self.patch_decoder = NumpyGPT2(weights, "patch_level_decoder.base")
+        self.char_decoder = NumpyGPT2(weights, "char_level_decoder.base.transformer")
+        self.wte = weights["char_level_decoder.base.transformer.wte.weight"]
+        self.lm_head = weights.get("char_level_decoder.base.lm_head.weight", self.wte)
+
+    @classmethod
+    def from_file(cls, path=f"{OUTPUT_PATH}/weights.pth"):
+        """
+        :param path: a torch checkpoint, or the .npz written by export_npz
+        """
+        return cls(load_weights(path))
+
+    def encode(self, patches: np.ndarray, past_key_values: list):
+        """
+        Encode new patches, continuing from the cached patches.
+        :param patches: the patches in shape [batch, n, PATCH_SIZE]
+        :return: the encoded patches in shape [batch, n, n_embd] and the updated keys and values
+        """
+        offsets = np.arange(PATCH_SIZE) * 128
+        embeddings = self.patch_embedding[patches + offsets].sum(2) + self.patch_embedding_bias
+        return self.patch_decoder.forward(embeddings, past_key_values)
+
+    def decode(self, encoded_patch: np.ndarray, tokens: np.ndarray, past_key_values: list = None):
+        """
+        Run the char-level decoder over tokens of the patch, see CharLevelDecoder.decode.
+        :param encoded_patch: the encoded patch of each sequence in shape [batch, n_embd]
+        :return: the probability distributions in shape [batch, n, vocab_size] and the updated keys and values
+        """
+        inputs_embeds = self.wte[tokens]
+        if past_key_values == None:
+            # the encoded patch takes the place of bos
+            inputs_embeds[:, 0] = encoded_patch
+            past_key_values = self.char_decoder.empty_cache(len(tokens))
+
+        hidden_states, past_key_values = self.char_decoder.forward(inputs_embeds, past_key_values)
+        return softmax(hidden_states @ self.lm_head.T), past_key_values
+
+    def sample_patch(
+        self,
+        encoded_patch: np.ndarray,
+        tokens: np.ndarray,
+        rngs: list,
+        top_p: float = 1,
+        top_k: int = 0,
+        temperature: float = 1,
+    ) -> np.ndarray:
+        """
+        Sample the next patch of each sequence, see utils.sample_patch.
+        :param tokens: the tokens the patch starts with in shape [batch, n], bos first
+        :param rngs: the numpy Generator of each sequence
+        :return: the generated tokens in shape [batch, n], padded after the eos token
+        """
+        pad_token_id = self.patchilizer.pad_token_id
+        eos_token_id = self.patchilizer.eos_token_id
+        batch_size = len(tokens)
+        probs, char_key_values = self.decode(encoded_patch, tokens)
+        num_steps = max(PATCH_SIZE - tokens.shape[1], 1)
+        generated = np.full((batch_size, num_steps), pad_token_id)
+        rows = list(range(batch_size))
+        for step in range(num_steps):
+            row_probs = adjust_probs(
+                probs[rows, -1].astype(np.float64), top_p, top_k, temperature
+            )
+            for row, prob in zip(rows, row_probs):
+                cumulative = np.cumsum(prob)
+                generated[row, step] = min(
+                    np.searchsorted(cumulative, rngs[row].random() * cumulative[-1], "right"),
+                    len(prob) - 1,
+                )
+
+            rows = [row for row in rows if generated[row, step] != eos_token_id]
+            if not rows or step == num_steps - 1:
+                break
+
+            probs, char_key_values = self.decode(
+                encoded_patch, generated[:, step : step + 1], char_key_values
+            )
+
+        return generated[:, : step + 1]
+
+    def generate(
+        self,
+        prompt: str,
+        num_tunes: int = 1,
+        max_patch: int = PATCH_LENGTH,
+        top_p: float = 0.8,
+        top_k: int = 8,
+        temperature: float = 1.2,
+        seed: int = None,
+    ) -> list:
+        """
+        Generate tunes from a prompt together, tune i is seeded with seed + i.
+        :return: the generated bars of each tune, excluding the prompt
+        """
+        if max_patch > PATCH_LENGTH:
+            raise ValueError(f"max_patch exceeds the {PATCH_LENGTH} patch positions")
+
+        patchilizer = self.patchilizer
+        prompt_patches = patchilizer.encode(prompt, add_special_patches=True)[:-1]
+        # the characters of the unfinished last bar of the prompt start the first patch
+        remaining = prompt[len(patchilizer.decode(prompt_patches)) :]
+        start = [patchilizer.bos_token_id] + [ord(c) for c in remaining][: PATCH_SIZE - 1]
+        rngs = [
+            np.random.default_rng(None if seed == None else seed + i)
+            for i in range(num_tunes)
+        ]
+        bars = [[] for _ in range(num_tunes)]
+        active = list(range(num_tunes))
+        new_patches = np.repeat(np.array([prompt_patches]), num_tunes, axis=0)
+        past_key_values = self.patch_decoder.empty_cache(num_tunes)
+        for _ in range(len(prompt_patches), max_patch):
+            encoded_patches, past_key_values = self.encode(new_patches, past_key_values)
+            generated = self.sample_patch(
+                encoded_patches[:, -1],
+                np.array([start] * len(active)),
+                [rngs[i] for i in active],
+                top_p,
+                top_k,
+                temperature,
+            )
+            patches, kept = [], []
+            for row, (i, tokens) in enumerate(zip(active, generated.tolist())):
+                if tokens[0] == patchilizer.eos_token_id:
+                    continue
+
+                if patchilizer.eos_token_id in tokens:
+                    tokens = tokens[: tokens.index(patchilizer.eos_token_id)]
+
+                # the same characters as GenerationState.commit keeps
+                chars = [token for token in tokens if token > patchilizer.eos_token_id]
+                if not chars:
+                    continue
+
+                patch = (start + chars + [patchilizer.eos_token_id])[:PATCH_SIZE]
+                patch += [patchilizer.pad_token_id] * (PATCH_SIZE - len(patch))
+                patches.append(patch)
+                bars[i].append(patchilizer.patch2bar(patch)[len(start) - 1 :])
+                kept.append(row)
+
+            if not kept:
+                break
+
+            active = [active[row] for row in kept]
+            new_patches = np.array(patches)[:, None]
+            past_key_values = [x[kept] for x in past_key_values]
+            start = [patchilizer.bos_token_id]
+
+        return bars
+
+
+def check_parity(weights: str, tune: str):
+    """
+    Compare the NumPy runtime with the PyTorch decoders on the patches of a tune.
+    It imports torch, unlike the runtime.
+    :return: the largest absolute differences of the encoded patches and of the char-level probabilities
+    """
+    import torch
+    from transformers import DynamicCache
+    from engine import load_model
+
+    model = load_model(weights, "cpu")
+    numpy_model = NumpyTunesFormer.from_file(weights)
+    patches = np.array([Patchilizer().encode(tune, add_special_patches=True)])
+    with torch.inference_mode():
+        encoded_patches, _ = model.encode(torch.from_numpy(patches[:, :-1]), DynamicCache())
+        numpy_encoded_patches, _ = numpy_model.encode(
+            patches[:, :-1], numpy_model.patch_decoder.empty_cache(1)
+        )
+        patch_error = np.abs(encoded_patches.numpy() - numpy_encoded_patches).max()
+        char_error = 0
+        for i, encoded_patch in enumerate(encoded_patches[0]):
+            probs, _ = model.char_level_decoder.decode(
+                encoded_patch, torch.from_numpy(patches[0, i + 1])
+            )
+            numpy_probs, _ = numpy_model.decode(
+                encoded_patch.numpy()[None], patches[:, i + 1]
+            )
+            char_error = max(char_error, np.abs(probs.numpy() - numpy_probs).max())
+
+    return patch_error, char_error
+
+
+def get_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-weights",
+        type=str,
+        default=f"{OUTPUT_PATH}/weights.pth",
+        help="a torch checkpoint, or the .npz written by -export",
+    )
+    parser.add_argument(
+        "-export",
+        type=str,
+        default=None,
+        help="write the weights to this .npz instead of generating",
+    )
+    parser.add_argument(
+        "-prompt",
+        type=str,
+        default="A:Q1\n",
+        help="the prompt shared by all tunes",
+    )
+    parser.add_argument(
+        "-num_tunes",
+        type=int,
+        default=1,
+        help="the number of independently computed returned tunes",
+    )
+    parser.add_argument(
+        "-max_patch",
+        type=int,
+        default=128,
+        help="integer to define the maximum length in tokens of each tune",
+    )
+    parser.add_argument("-top_p", type=float, default=0.8, help="top p")
+    parser.add_argument("-top_k", type=int, default=8, help="top k")
+    parser.add_argument("-temperature", type=float, default=1.2, help="temperature")
+    parser.add_argument("-seed", type=int, default=None, help="seed for randomstate")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    args = get_args(parser)
+    if args.export:
+        print(export_npz(args.weights, args.export))
+
+    else:
+        start_time = time.time()
+        model = NumpyTunesFormer.from_file(args.weights)
+        print("Load time: {:.2f} seconds".format(time.time() - start_time))
+        tunes = model.generate(
+            args.prompt,
+            args.num_tunes,
+            args.max_patch,
+            args.top_p,
+            args.top_k,
+            args.temperature,
+            args.seed,
+        )
+        for i, bars in enumerate(tunes):
+            print(f"X:{i + 1}\n{args.prompt}{''.join(bars)}", end="\n\n")
+
+        print("Generation time: {:.2f} seconds".format(time.time() - start_time))
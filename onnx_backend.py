@@ -0,0 +1,346 @@
+import os
+import argparse
+import warnings
+import numpy as np
+import torch
+from transformers import GPT2Model, DynamicCache
+from utils import TunesFormer, Patchilizer, sample_patch
+from config import *
+
+
+def gpt2_forward(transformer: GPT2Model, inputs_embeds: torch.Tensor, past_key_values: list):
+    """
+    A GPT-2 forward over explicit key/value tensors, which traces into an ONNX graph with a dynamic past length.
+    :param past_key_values: the keys and values of the layers in turn, each in shape [batch, heads, past, head_dim]
+    :return: the last hidden states and the keys and values including the new positions
+    """
+    past_length = past_key_values[0].shape[2]
+    positions = torch.arange(
+        past_length, past_length + inputs_embeds.shape[1], device=inputs_embeds.device
+    )
+    hidden_states = inputs_embeds + transformer.wpe(positions)
+    # each position attends to the positions up to itself
+    attention_mask = (
+        torch.arange(past_length + inputs_embeds.shape[1], device=inputs_embeds.device)
+        <= positions[:, None]
+    )
+    present_key_values = []
+    for i, block in enumerate(transformer.h):
+        attn = block.attn
+        query, key, value = attn.c_attn(block.ln_1(hidden_states)).split(
+            attn.embed_dim, dim=2
+        )
+        query, key, value = (
+            x.reshape(x.shape[0], -1, attn.num_heads, attn.head_dim).transpose(1, 2)
+            for x in (query, key, value)
+        )
+        key = torch.cat((past_key_values[2 * i], key), dim=2)
+        value = torch.cat((past_key_values[2 * i + 1], value), dim=2)
+        present_key_values += [key, value]
+        attn_output = torch.nn.functional.scaled_dot_product_attention(
+            query, key, value, attn_mask=attention_mask
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(
+            hidden_states.shape[0], -1, attn.embed_dim
+        )
+        hidden_states = hidden_states + attn.c_proj(attn_output)
+        hidden_states = hidden_states + block.mlp(block.ln_2(hidden_states))
+
+    return transformer.ln_f(hidden_states), present_key_values
+
+
+class PatchStep(torch.nn.Module):
+    """
+    The patch-level decoder step exported to ONNX.
+    """
+
+    def __init__(self, model: TunesFormer):
+        super().__init__()
+        self.decoder = model.patch_level_decoder
+
+    def forward(self, patches: torch.Tensor, *past_key_values):
+        # the same sum of patch_embedding columns as embed_patches, with a gather instead of embedding_bag
+        offsets = torch.arange(PATCH_SIZE, device=patches.device) * 128
+        embeddings = self.decoder.patch_embedding.weight.t()[patches + offsets].sum(2)
+        embeddings = embeddings + self.decoder.patch_embedding.bias
+        hidden_states, present_key_values = gpt2_forward(
+            self.decoder.base, embeddings, past_key_values
+        )
+        return (hidden_states, *present_key_values)
+
+
+class CharStep(torch.nn.Module):
+    """
+    The char-level decoder step exported to ONNX, the encoded patch takes the place of bos at the first position.
+    """
+
+    def __init__(self, model: TunesFormer):
+        super().__init__()
+        self.decoder = model.char_level_decoder.base
+
+    def forward(self, encoded_patch: torch.Tensor, tokens: torch.Tensor, *past_key_values):
+        inputs_embeds = self.decoder.transformer.wte(tokens)
+        first = (
+            torch.arange(tokens.shape[1], device=tokens.device)
+            + past_key_values[0].shape[2]
+            == 0
+        )
+        inputs_embeds = torch.where(
+            first[None, :, None], encoded_patch[:, None], inputs_embeds
+        )
+        hidden_states, present_key_values = gpt2_forward(
+            self.decoder.transformer, inputs_embeds, past_key_values
+        )
+        probs = torch.nn.functional.softmax(self.decoder.lm_head(hidden_states), dim=-1)
+        return (probs, *present_key_values)
+
+
+def cache_names(num_layers: int, prefix: str):
+    return [f"{prefix}_{kind}_{i}" for i in range(num_layers) for kind in ("key", "value")]
+
+
+def export_step(step: torch.nn.Module, inputs: dict, output_name: str, path: str):
+    config = step.decoder.config
+    num_heads = config.n_head
+    head_dim = config.n_embd // num_heads
+    past_names = cache_names(config.n_layer, "past")
+    present_names = cache_names(config.n_layer, "present")
+    past_key_values = [
+        torch.zeros(1, num_heads, 1, head_dim) for _ in range(2 * config.n_layer)
+    ]
+    dynamic_axes = {name: {0: "batch", 1: "length"} for name in inputs}
+    dynamic_axes[output_name] = {0: "batch", 1: "length"}
+    dynamic_axes.update({name: {0: "batch", 2: "past"} for name in past_names})
+    dynamic_axes.update({name: {0: "batch", 2: "total"} for name in present_names})
+    torch.onnx.export(
+        step,
+        (*inputs.values(), *past_key_values),
+        path,
+        input_names=list(inputs) + past_names,
+        output_names=[output_name] + present_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=17,
+        dynamo=False,
+    )
+
+
+def export_onnx(model: TunesFormer, output_dir=f"{OUTPUT_PATH}/onnx"):
+    """
+    Export the patch-level and char-level decoder steps of a model with their key/value caches to ONNX.
+    :param model: an fp32 TunesFormer
+    :return: the paths of the patch-level and char-level graphs
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.to("cpu").eval()
+    patch_path = f"{output_dir}/patch_decoder.onnx"
+    char_path = f"{output_dir}/char_decoder.onnx"
+    with torch.no_grad():
+        export_step(
+            PatchStep(model).eval(),
+            {"patches": torch.ones(1, 2, PATCH_SIZE, dtype=torch.long)},
+            "hidden_states",
+            patch_path,
+        )
+        export_step(
+            CharStep(model).eval(),
+            {
+                "encoded_patch": torch.zeros(1, model.char_level_decoder.config.n_embd),
+                "tokens": torch.ones(1, 2, dtype=torch.long),
+            },
+            "probs",
+            char_path,
+        )
+
+    return patch_path, char_path
+
+
+class OnnxCache:
+    """
+    The patch-level keys and values of a batch for OnnxTunesFormer.
+    """
+
+    def __init__(self, key_values: list):
+        self.key_values = key_values
+
+    def batch_select_indices(self, indices: torch.Tensor):
+        indices = indices.cpu().numpy()
+        self.key_values = [x[indices] for x in self.key_values]
+
+    def crop(self, max_length: int):
+        """
+        Keep the first max_length patch positions.
+        """
+        self.key_values = [np.ascontiguousarray(x[:, :, :max_length]) for x in self.key_values]
+
+
+class OnnxTunesFormer:
+    """
+    Decodes with the graphs written by export_onnx through onnxruntime instead of torch.
+    It samples the same patches as TunesFormer.generate_batch up to float rounding.
+    """
+
+    def __init__(self, onnx_dir=f"{OUTPUT_PATH}/onnx", providers=("CPUExecutionProvider",)):
+        import onnxruntime
+
+        self.patch_session = onnxruntime.InferenceSession(
+            f"{onnx_dir}/patch_decoder.onnx", providers=list(providers)
+        )
+        self.char_session = onnxruntime.InferenceSession(
+            f"{onnx_dir}/char_decoder.onnx", providers=list(providers)
+        )
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    def empty_cache(self, session, batch_size: int):
+        key_values = []
+        for cache_input in session.get_inputs():
+            if cache_input.name.startswith("past_"):
+                _, num_heads, _, head_dim = cache_input.shape
+                key_values.append(
+                    np.zeros((batch_size, num_heads, 0, head_dim), dtype=np.float32)
+                )
+
+        return key_values
+
+    def run(self, session, inputs: dict, past_key_values: list):
+        names = [x.name for x in session.get_inputs() if x.name.startswith("past_")]
+        outputs = session.run(None, {**inputs, **dict(zip(names, past_key_values))})
+        return outputs[0], outputs[1:]
+
+    def new_cache(self, batch_size: int) -> OnnxCache:
+        return OnnxCache(self.empty_cache(self.patch_session, batch_size))
+
+    def encode(self, patches: torch.Tensor, past_key_values: OnnxCache):
+        """
+        Encode the new patches, continuing from the cached patches.
+        :return: the encoded patches in shape [batch, n, n_embd]
+        """
+        hidden_states, past_key_values.key_values = self.run(
+            self.patch_session,
+            {"patches": patches.reshape(len(patches), -1, PATCH_SIZE).cpu().numpy()},
+            past_key_values.key_values,
+        )
+        return hidden_states
+
+    def decode(self, encoded_patch: np.ndarray, tokens: torch.Tensor, past_key_values: list = None):
+        """
+        Run the char-level decoder over tokens of the patch, see CharLevelDecoder.decode.
+        :return: the probability distributions in shape [batch, n, vocab_size] and the updated keys and values
+        """
+        if past_key_values == None:
+            past_key_values = self.empty_cache(self.char_session, len(encoded_patch))
+
+        probs, past_key_values = self.run(
+            self.char_session,
+            {"encoded_patch": encoded_patch, "tokens": tokens.cpu().numpy()},
+            past_key_values,
+        )
+        return torch.from_numpy(probs), past_key_values
+
+    def generate_batch(
+        self,
+        patches: torch.Tensor,
+        tokens: torch.Tensor,
+        top_p: float = 1,
+        top_k: int = 0,
+        temperature: float = 1,
+        random_states: list = None,
+        past_key_values: OnnxCache = None,
+        constrained: bool = False,
+        line_starts: list = None,
+    ):
+        """
+        The onnxruntime version of TunesFormer.generate_batch.
+        :param past_key_values: the patch-level cache of the batch from new_cache
+        """
+        encoded_patch = self.encode(patches, past_key_values)[:, -1]
+
+        def char_step(new_tokens: torch.Tensor, char_key_values: list):
+            probs, char_key_values = self.decode(encoded_patch, new_tokens, char_key_values)
+            return probs[:, -1], char_key_values
+
+        return sample_patch(
+            char_step,
+            len(patches),
+            tokens,
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+            random_states=random_states,
+            device=self.device,
+            constrained=constrained,
+            line_starts=line_starts,
+        )
+
+
+@torch.inference_mode()
+def check_parity(model: TunesFormer, onnx_model: OnnxTunesFormer, tune: str):
+    """
+    Compare the ONNX graphs with the PyTorch decoders on the patches of a tune.
+    :param model: the fp32 TunesFormer the graphs were exported from, on the CPU
+    :param tune: a tune in ABC notation
+    :return: the largest absolute differences of the encoded patches and of the char-level probabilities
+    """
+    patches = torch.tensor([Patchilizer().encode(tune, add_special_patches=True)])
+    encoded_patches, _ = model.encode(patches[:, :-1], DynamicCache())
+    onnx_encoded_patches = onnx_model.encode(patches[:, :-1], onnx_model.new_cache(1))
+    patch_error = np.abs(encoded_patches.numpy() - onnx_encoded_patches).max()
+
+    # teacher-force the next patch, half at once and the rest from the cache
+    char_error = 0
+    targets = patches[0, 1:]
+    half = PATCH_SIZE // 2
+    for i, encoded_patch in enumerate(encoded_patches[0]):
+        probs, key_values = model.char_level_decoder.decode(
+            encoded_patch, targets[i, :half]
+        )
+        onnx_probs, onnx_key_values = onnx_model.decode(
+            encoded_patch.reshape(1, -1).numpy(), targets[i : i + 1, :half]
+        )
+        char_error = max(char_error, (probs - onnx_probs).abs().max().item())
+        probs, _ = model.char_level_decoder.decode(
+            encoded_patch, targets[i, half:], key_values
+        )
+        onnx_probs, _ = onnx_model.decode(
+            encoded_patch.reshape(1, -1).numpy(),
+            targets[i : i + 1, half:],
+            onnx_key_values,
+        )
+        char_error = max(char_error, (probs - onnx_probs).abs().max().item())
+
+    return patch_error, char_error
+
+
+def get_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-weights",
+        type=str,
+        default=f"{OUTPUT_PATH}/weights.pth",
+        help="weights path",
+    )
+    parser.add_argument(
+        "-onnx_dir",
+        type=str,
+        default=f"{OUTPUT_PATH}/onnx",
+        help="the directory the ONNX graphs are written to",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from engine import load_model
+
+    warnings.filterwarnings("ignore")
+    parser = argparse.ArgumentParser()
+    args = get_args(parser)
+    model = load_model(args.weights, "cpu")
+    export_onnx(model, args.onnx_dir)
+    patch_error, char_error = check_parity(
+        model,
+        OnnxTunesFormer(args.onnx_dir),
+        'A:Q1\nS:2\nB:9\nE:4\nB:9\nL:1/8\nM:3/4\nK:D\n de |"D" f3 e d2 |"A" c3 B A2 |"D" d6 |]\n',
+    )
+    print(f"Patch-level max abs error: {patch_error:.2e}")
+    print(f"Char-level max abs error: {char_error:.2e}")
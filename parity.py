@@ -0,0 +1,127 @@
+import time
+import argparse
+import warnings
+import torch
+from music21 import converter
+from engine import GenerationEngine, GenerationParams, model_nbytes, render_tune
+from precision import PRECISIONS
+from config import *
+
+PARITY_PROMPTS = ["A:Q1\n", "A:Q2\n", "A:Q3\n", "A:Q4\n"]
+
+
+def get_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-weights",
+        type=str,
+        default=f"{OUTPUT_PATH}/weights.pth",
+        help="weights path",
+    )
+    parser.add_argument(
+        "-precision",
+        type=str,
+        default="int8",
+        choices=PRECISIONS,
+        help="the precision to compare against fp32",
+    )
+    parser.add_argument(
+        "-num_seeds",
+        type=int,
+        default=8,
+        help="the number of seeds generated per prompt",
+    )
+    parser.add_argument(
+        "-max_patch",
+        type=int,
+        default=128,
+        help="integer to define the maximum length in tokens of each tune",
+    )
+    return parser.parse_args()
+
+
+def parse_rate(tunes: list):
+    """
+    The fraction of tunes music21 can parse.
+    """
+    success = 0
+    for tune in tunes:
+        try:
+            converter.parse(tune, format="abc")
+            success += 1
+
+        except Exception:
+            pass
+
+    return success / max(len(tunes), 1)
+
+
+def token_log_likelihood(engine: GenerationEngine, patches: torch.Tensor):
+    """
+    The mean log-likelihood per character of a tune under the model of an engine.
+    """
+    with torch.inference_mode():
+        return -engine.model(patches.unsqueeze(0).to(engine.device)).loss.item()
+
+
+def generate_all(engine: GenerationEngine, params: GenerationParams):
+    tunes = []
+    for prompt in PARITY_PROMPTS:
+        for generated_tune in engine.generate(prompt, params):
+            tune = render_tune(f"X:1\n{prompt}", generated_tune.bars)
+            tunes.append((tune, generated_tune.patches))
+
+    return tunes
+
+
+def parity_report(
+    reference: GenerationEngine,
+    candidate: GenerationEngine,
+    num_seeds=8,
+    max_patch=128,
+):
+    """
+    Compare a candidate engine with the fp32 reference on a fixed set of prompts and seeds.
+    :return: the parse rates, mean token log-likelihoods on the reference tunes,
+    their drift, generation times and model sizes
+    """
+    params = GenerationParams(
+        num_tunes=num_seeds,
+        batch_size=num_seeds,
+        max_patch=max_patch,
+        seed=0,
+    )
+    report = {}
+    tunes = {}
+    for name, engine in (("reference", reference), ("candidate", candidate)):
+        start_time = time.time()
+        tunes[name] = generate_all(engine, params)
+        report[f"{name}_time"] = time.time() - start_time
+        report[f"{name}_parse_rate"] = parse_rate([tune for tune, _ in tunes[name]])
+        report[f"{name}_bytes"] = model_nbytes(engine.model)
+
+    # score the same reference tunes with both models
+    reference_ll, candidate_ll = [], []
+    for _, patches in tunes["reference"]:
+        reference_ll.append(token_log_likelihood(reference, patches))
+        candidate_ll.append(token_log_likelihood(candidate, patches))
+
+    report["reference_log_likelihood"] = sum(reference_ll) / len(reference_ll)
+    report["candidate_log_likelihood"] = sum(candidate_ll) / len(candidate_ll)
+    report["log_likelihood_drift"] = sum(
+        abs(a - b) for a, b in zip(reference_ll, candidate_ll)
+    ) / len(reference_ll)
+    return report
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+    parser = argparse.ArgumentParser()
+    args = get_args(parser)
+    reference = GenerationEngine.from_weights(args.weights, "cpu")
+    candidate = GenerationEngine.from_weights(
+        args.weights, "cpu", precision=args.precision
+    )
+    report = parity_report(reference, candidate, args.num_seeds, args.max_patch)
+    print(f" fp32 vs {args.precision} ".center(60, "#"))
+    for key, value in report.items():
+        print(f"{key}: {value}")
@@ -0,0 +1,108 @@
+import re
+from unidecode import unidecode
+from config import *
+
+
+class Patchilizer:
+    """
+    A class for converting music bars to patches and vice versa.
+    """
+
+    def __init__(self):
+        self.delimiters = ["|:", "::", ":|", "[|", "||", "|]", "|"]
+        self.regexPattern = f"({'|'.join(map(re.escape, self.delimiters))})"
+        self.pad_token_id = 0
+        self.bos_token_id = 1
+        self.eos_token_id = 2
+
+    def split_bars(self, body):
+        """
+        Split a body of music into individual bars.
+        """
+        bars = re.split(self.regexPattern, "".join(body))
+        bars = list(filter(None, bars))
+        # remove empty strings
+        if bars[0] in self.delimiters:
+            bars[1] = bars[0] + bars[1]
+            bars = bars[1:]
+
+        bars = [bars[i * 2] + bars[i * 2 + 1] for i in range(len(bars) // 2)]
+        return bars
+
+    def is_header_line(self, line):
+        """
+        Whether a line is an information field or a %%score directive rather than music.
+        """
+        return len(line) > 1 and (
+            (line[0].isalpha() and line[1] == ":") or line.startswith("%%score")
+        )
+
+    def bar2patch(self, bar, patch_size=PATCH_SIZE):
+        """
+        Convert a bar into a patch of specified length.
+        """
+        patch = [self.bos_token_id] + [ord(c) for c in bar] + [self.eos_token_id]
+        patch = patch[:patch_size]
+        patch += [self.pad_token_id] * (patch_size - len(patch))
+        return patch
+
+    def patch2bar(self, patch):
+        """
+        Convert a patch into a bar.
+        """
+        return "".join(
+            chr(idx) if idx > self.eos_token_id else ""
+            for idx in patch
+            if idx != self.eos_token_id
+        )
+
+    def encode(
+        self,
+        abc_code,
+        patch_length=PATCH_LENGTH,
+        patch_size=PATCH_SIZE,
+        add_special_patches=False,
+    ):
+        """
+        Encode music into patches of specified length.
+        """
+        lines = unidecode(abc_code).split("\n")
+        lines = list(filter(None, lines))  # remove empty lines
+
+        body = ""
+        patches = []
+
+        for line in lines:
+            if self.is_header_line(line):
+                if body:
+                    bars = self.split_bars(body)
+                    patches.extend(
+                        self.bar2patch(
+                            bar + "\n" if idx == len(bars) - 1 else bar, patch_size
+                        )
+                        for idx, bar in enumerate(bars)
+                    )
+                    body = ""
+
+                patches.append(self.bar2patch(line + "\n", patch_size))
+
+            else:
+                body += line + "\n"
+
+        if body:
+            patches.extend(
+                self.bar2patch(bar, patch_size) for bar in self.split_bars(body)
+            )
+
+        if add_special_patches:
+            bos_patch = [self.bos_token_id] * (patch_size - 1) + [self.eos_token_id]
+            eos_patch = [self.bos_token_id] + [self.eos_token_id] * (patch_size - 1)
+            patches = [bos_patch] + patches + [eos_patch]
+
+        return patches[:patch_length]
+
+    def decode(self, patches):
+        """
+        Decode patches into music.
+        """
+        return "".join(self.patch2bar(patch) for patch in patches)
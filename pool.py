@@ -0,0 +1,134 @@
+import os
+import queue
+import multiprocessing as mp
+import torch
+from engine import MODEL_CACHE
+from utils import DEVICE
+
+
+def available_cores() -> list:
+    """
+    The cores this process may run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores: list, num_workers: int) -> list:
+    """
+    Split cores into contiguous sets, one per worker, the first sets take the remainder.
+    """
+    size, remainder = divmod(len(cores), num_workers)
+    core_sets, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (i < remainder)
+        core_sets.append(cores[start:end])
+        start = end
+
+    return core_sets
+
+
+def init_worker(core_sets: mp.Queue, num_threads: int):
+    """
+    Bound the intra-op threads of a worker and pin it to the next free core set, if any.
+    """
+    try:
+        cores = core_sets.get(timeout=5)
+
+    except queue.Empty:
+        # a worker restarted by the pool runs unpinned
+        cores = None
+
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    torch.set_num_threads(num_threads)
+
+
+def preload_models(weights: list, precision="fp32"):
+    """
+    Load models into the model cache of this process with their weights in shared memory,
+    so forked workers read the same pages instead of loading their own copies.
+    """
+    if str(DEVICE) != "cpu":
+        raise ValueError("Pre-forking workers only shares weights for CPU inference")
+
+    for path in weights:
+        model = MODEL_CACHE.get(path, DEVICE, precision).model
+        model.share_memory()
+        # the workers inherit the contiguous patch embedding columns instead of copying them each
+        with torch.no_grad():
+            model.patch_level_decoder.embedding_columns()
+
+
+class WorkerPool:
+    """
+    A pool of generation processes for CPU inference.
+    Each worker runs torch with a bounded number of threads and optionally pinned to its own cores.
+    By default each worker loads its own model on its first job and keeps it in its process-wide model cache,
+    with preload the models are loaded once in this process and the workers are forked to share them.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = None,
+        num_threads: int = None,
+        pin=False,
+        preload: list = None,
+        precision="fp32",
+    ):
+        """
+        Start the workers.
+        :param num_workers: the number of processes, by default one per 4 available cores
+        :param num_threads: the torch threads of each worker, by default its share of the available cores
+        :param pin: whether to pin each worker to a contiguous set of cores
+        :param preload: the weights to load before forking the workers, None to spawn workers that load their own
+        :param precision: the precision of the preloaded models
+        """
+        cores = available_cores()
+        self.num_workers = num_workers or max(len(cores) // 4, 1)
+        self.num_threads = num_threads or max(len(cores) // self.num_workers, 1)
+        if preload:
+            preload_models(preload, precision)
+            # forked workers start at once with the model cache of this process
+            context = mp.get_context("fork")
+
+        else:
+            # spawn so the workers do not inherit the OpenMP state of a parent that already ran torch
+            context = mp.get_context("spawn")
+
+        core_sets = context.Queue()
+        for core_set in split_cores(cores, self.num_workers):
+            core_sets.put(core_set if pin else None)
+
+        self.pool = context.Pool(
+            self.num_workers,
+            initializer=init_worker,
+            initargs=(core_sets, self.num_threads),
+        )
+
+    def map(self, function, jobs: list) -> list:
+        """
+        Run a picklable module-level function on every job, handing out one job at a time.
+        :return: the results in the order of the jobs
+        """
+        return self.pool.map(function, jobs, chunksize=1)
+
+    def imap(self, function, jobs: list):
+        """
+        The streaming version of map.
+        :return: an iterator of the results as they finish, in any order
+        """
+        return self.pool.imap_unordered(function, jobs)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
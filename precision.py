@@ -0,0 +1,100 @@
+import torch
+import torch.nn as nn
+from transformers.pytorch_utils import Conv1D
+from utils import TunesFormer
+
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+
+def conv1d_to_linear(module: nn.Module):
+    """
+    Replace the GPT-2 Conv1D layers of a module by the equivalent nn.Linear layers in place.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = nn.Linear(child.weight.shape[0], child.nf)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+
+        else:
+            conv1d_to_linear(child)
+
+    return module
+
+
+def quantize_int8(model: TunesFormer):
+    """
+    Dynamically quantize the linear layers in the GPT-2 blocks of both decoders to int8 for CPU inference.
+    The embeddings, layer norms and LM head stay in fp32.
+    :param model: a TunesFormer loaded from fp32 weights, moved to the CPU
+    :return: the quantized model
+    """
+    model = model.to("cpu")
+    for blocks in (
+        model.patch_level_decoder.base.h,
+        model.char_level_decoder.base.transformer.h,
+    ):
+        conv1d_to_linear(blocks)
+        torch.ao.quantization.quantize_dynamic(
+            blocks, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+    return model
+
+
+def cast_blocks(blocks: nn.ModuleList, dtype: torch.dtype):
+    """
+    Cast a stack of GPT-2 blocks to a dtype in place, casting the hidden states at its boundaries.
+    The blocks run in the dtype and hand their output back in fp32.
+    """
+    blocks.to(dtype)
+
+    def cast_inputs(module, args):
+        return tuple(
+            arg.to(dtype) if isinstance(arg, torch.Tensor) and arg.is_floating_point() else arg
+            for arg in args
+        )
+
+    def cast_outputs(module, args, outputs):
+        # the blocks return their hidden states alone or first in a tuple, depending on the transformers version
+        if isinstance(outputs, torch.Tensor):
+            return outputs.float()
+
+        return (outputs[0].float(), *outputs[1:])
+
+    blocks[0].register_forward_pre_hook(cast_inputs)
+    blocks[-1].register_forward_hook(cast_outputs)
+    return blocks
+
+
+def cast_bf16(model: TunesFormer):
+    """
+    Cast the weights of the GPT-2 blocks in both decoders to bfloat16, halving the memory read per forward.
+    The embeddings, final layer norms and LM head stay in fp32, so the probabilities are computed in fp32.
+    :param model: a TunesFormer loaded from fp32 weights
+    :return: the cast model
+    """
+    for blocks in (
+        model.patch_level_decoder.base.h,
+        model.char_level_decoder.base.transformer.h,
+    ):
+        cast_blocks(blocks, torch.bfloat16)
+
+    return model
+
+
+def convert_precision(model: TunesFormer, precision: str):
+    """
+    Convert a loaded fp32 model for inference in the given precision.
+    """
+    if precision == "bf16":
+        return cast_bf16(model)
+
+    if precision == "int8":
+        return quantize_int8(model)
+
+    if precision != "fp32":
+        raise ValueError(f"Unsupported precision {precision}, expected one of {PRECISIONS}")
+
+    return model
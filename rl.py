@@ -5,8 +5,8 @@ import torch.optim as optim
 from torch import Tensor
 from torch.distributions import Categorical
 from tqdm import tqdm
-from transformers import GPT2Config
-from utils import TunesFormer, Patchilizer, DEVICE
+from utils import Patchilizer, DEVICE
+from engine import build_model
 from modelscope.msdatasets import MsDataset
 from modelscope import snapshot_download
 from generate import infer_abc
@@ -74,19 +74,7 @@ class PPOTrainer:
         weights_path=snapshot_download("Genius-Society/tunesformer", cache_dir=TEMP_DIR)
         + "/weights.pth",
     ):
-        patch_config = GPT2Config(
-            num_hidden_layers=PATCH_NUM_LAYERS,
-            max_length=PATCH_LENGTH,
-            max_position_embeddings=PATCH_LENGTH,
-            vocab_size=1,
-        )
-        char_config = GPT2Config(
-            num_hidden_layers=CHAR_NUM_LAYERS,
-            max_length=PATCH_SIZE,
-            max_position_embeddings=PATCH_SIZE,
-            vocab_size=128,
-        )
-        model = TunesFormer(patch_config, char_config, share_weights=SHARE_WEIGHTS)
+        model = build_model()
         if torch.cuda.device_count() > 1:
             model = torch.nn.DataParallel(model)
 
@@ -0,0 +1,394 @@
+import time
+import queue
+import threading
+from collections import deque
+import torch
+from utils import GenerationState, RandomState, adjust_probs, sample_tokens, repeat_cache
+from grammar import AbcAutomaton, mask_probs
+from engine import (
+    GenerationEngine,
+    GenerationParams,
+    GeneratedTune,
+    BarEvent,
+    exhausted_rows,
+)
+from config import *
+
+
+class ScheduledRequest:
+    """
+    A generation request submitted to a Scheduler, each of its tunes takes a slot of the running batch.
+    """
+
+    def __init__(self, prompt: str, params: GenerationParams):
+        self.prompt = prompt
+        self.params = params
+        self.tunes = [GeneratedTune() for _ in range(params.num_tunes)]
+        self.events = queue.Queue()
+        self.submit_time = time.time()
+        # the deadline counts the time spent waiting for a slot
+        self.deadline = None
+        if params.deadline != None:
+            self.deadline = self.submit_time + params.deadline
+        self.num_finished = 0
+        self.done = threading.Event()
+        self.error = None
+
+    def stream(self):
+        """
+        Yield the BarEvent of each bar of the request as soon as it is sampled.
+        :raises: the error the request failed with, after its last bar
+        """
+        while True:
+            event = self.events.get()
+            if event == None:
+                break
+
+            yield event
+
+        if self.error != None:
+            raise self.error
+
+    def result(self, timeout: float = None) -> list:
+        """
+        Wait for all tunes of the request.
+        :raises: TimeoutError when the tunes are not finished within the timeout, or the error the request failed with
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"request not finished within {timeout} seconds")
+
+        if self.error != None:
+            raise self.error
+
+        return self.tunes
+
+    def fail(self, error: Exception):
+        """
+        End the request with an error, the waiting callers raise it.
+        """
+        if not self.done.is_set():
+            self.error = error
+            self.events.put(None)
+            self.done.set()
+
+
+class Slot:
+    """
+    A tune being decoded in the running batch, with its own patch-level cache and random state.
+    """
+
+    def __init__(self, engine: GenerationEngine, request: ScheduledRequest, tune: int):
+        params = request.params
+        self.request = request
+        self.tune = tune
+        self.state = GenerationState(
+            engine.patchilizer, request.prompt, 1, params.max_patch, engine.device
+        )
+        seed = None if params.seed == None else params.seed + tune
+        self.random_state = RandomState(seed, engine.device)
+
+        prefix = engine.prefix_cache.get(
+            request.prompt,
+            lambda: engine.model.encode_prefix(
+                self.state.patches[:, : self.state.prompt_length],
+                self.state.next_tokens(),
+            ),
+        )
+        self.past_key_values = repeat_cache(prefix.patch_key_values, 1)
+        self.encoded_patch = prefix.encoded_patch
+        self.state.num_encoded = self.state.prompt_length
+
+    @property
+    def finished(self):
+        return not self.state.active or self.state.num_patches >= self.request.params.max_patch
+
+    def truncate_exhausted(self, step_time: float = 0):
+        """
+        Truncate the tune when its next patch would overrun the deadline or token budget of its request.
+        :return: whether the tune was truncated
+        """
+        request = self.request
+        rows = exhausted_rows(self.state, request.params, request.deadline, step_time)
+        self.state.truncate(rows)
+        return bool(rows)
+
+
+class Scheduler:
+    """
+    Continuous batching of generation requests on the model of an engine.
+    One batch keeps running, a tune that ends frees its slot for the next waiting tune at the following patch.
+    The slots encode their patches with their own patch-level caches and sample the characters of their next patch
+    together, each with the top_p, top_k and temperature of its request.
+    The characters left in the unfinished last bar of a prompt are forced instead of sampled.
+    The patch-level decoder still runs once per slot at batch size 1, as the slots hold caches of different lengths,
+    only the char-level decoder is batched across requests.
+    An error while admitting a tune fails its request, an error in a step fails every request and stops the thread.
+    """
+
+    def __init__(self, engine: GenerationEngine, max_batch_size=8):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.waiting = deque()
+        self.slots = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.error = None
+        self.num_steps = 0
+        self.num_finished = 0
+        self.total_occupancy = 0
+
+    def submit(self, prompt: str, params: GenerationParams = None) -> ScheduledRequest:
+        """
+        Queue a request, its tunes join the running batch as slots free up.
+        """
+        request = ScheduledRequest(prompt, params if params != None else GenerationParams())
+        with self.lock:
+            if self.error != None:
+                request.fail(self.error)
+                return request
+
+            self.waiting.extend((request, tune) for tune in range(request.params.num_tunes))
+
+        return request
+
+    def metrics(self) -> dict:
+        """
+        The queue depth in tunes and the occupancy of the running batch, now and averaged over the steps.
+        """
+        with self.lock:
+            return {
+                "queue_depth": len(self.waiting),
+                "active_slots": len(self.slots),
+                "occupancy": len(self.slots) / self.max_batch_size,
+                "mean_occupancy": self.total_occupancy / max(self.num_steps, 1),
+                "steps": self.num_steps,
+                "finished_tunes": self.num_finished,
+            }
+
+    def admit(self):
+        while len(self.slots) < self.max_batch_size:
+            with self.lock:
+                if not self.waiting:
+                    break
+
+                request, tune = self.waiting.popleft()
+
+            if request.error != None:
+                continue
+
+            try:
+                slot = Slot(self.engine, request, tune)
+
+            except Exception as e:
+                request.fail(e)
+                continue
+
+            if slot.finished or slot.truncate_exhausted():
+                self.finish(slot)
+
+            else:
+                self.slots.append(slot)
+
+    def finish(self, slot: Slot):
+        request = slot.request
+        request.tunes[slot.tune] = GeneratedTune(
+            bars=slot.state.bars(0),
+            patches=slot.state.patches[0, : slot.state.lengths[0]].clone(),
+            truncated=slot.state.truncated[0],
+        )
+        request.num_finished += 1
+        self.num_finished += 1
+        if request.num_finished == len(request.tunes):
+            request.events.put(None)
+            request.done.set()
+
+    @torch.inference_mode()
+    def step(self):
+        """
+        Admit waiting tunes and sample the next patch of every slot.
+        :return: whether any tune is still running or waiting
+        """
+        self.admit()
+        # the tunes of a request that failed while admitting its other tunes are dropped
+        self.slots = [slot for slot in self.slots if slot.request.error == None]
+        if not self.slots:
+            return False
+
+        step_start = time.time()
+        model = self.engine.model
+        for slot in self.slots:
+            if slot.state.num_positions > PATCH_LENGTH:
+                slot.state.slide_window(slot.request.params.evict_patches)
+                slot.past_key_values.crop(slot.state.num_pinned)
+
+            patches = slot.state.new_patches()
+            if patches.shape[1] > 0:
+                encoded_patches, _ = model.encode(patches, slot.past_key_values)
+                slot.encoded_patch = encoded_patches[:, -1]
+
+        generated = self.sample_patches()
+        for slot, tokens in zip(self.slots, generated):
+            slot.state.commit(tokens.unsqueeze(0))
+
+        self.num_steps += 1
+        self.total_occupancy += len(self.slots) / self.max_batch_size
+        step_time = time.time() - step_start
+        slots = []
+        for slot in self.slots:
+            state = slot.state
+            if state.active:
+                index = state.lengths[0] - state.prompt_length - 1
+                slot.request.events.put(
+                    BarEvent(
+                        tune=slot.tune,
+                        index=index,
+                        bar=state.bar(0, index),
+                        num_tokens=state.num_sampled[0],
+                        step_time=step_time,
+                        elapsed=time.time() - slot.request.submit_time,
+                    )
+                )
+
+            if slot.finished or slot.truncate_exhausted(step_time):
+                self.finish(slot)
+
+            else:
+                slots.append(slot)
+
+        self.slots = slots
+        return bool(self.slots or self.waiting)
+
+    def sample_patches(self):
+        """
+        Sample the next patch of every slot with one char-level forward per character.
+        :return: the sampled tokens of each slot after its forced tokens, up to its eos token
+        """
+        model = self.engine.model
+        device = self.engine.device
+        batch_size = len(self.slots)
+        forced = [slot.state.next_tokens()[0, 1:].tolist() for slot in self.slots]
+        num_steps = [max(PATCH_SIZE - 1 - len(tokens), 1) for tokens in forced]
+        generated = torch.full(
+            (batch_size, max(num_steps)), model.pad_token_id, dtype=torch.long, device=device
+        )
+        num_generated = [0] * batch_size
+        finished = [False] * batch_size
+        groups = {}
+        automata = {}
+        for row, slot in enumerate(self.slots):
+            params = slot.request.params
+            groups.setdefault((params.top_p, params.top_k, params.temperature), []).append(row)
+            if params.constrained:
+                automata[row] = AbcAutomaton(
+                    forced[row], line_start=slot.state.line_starts()[0]
+                )
+
+        encoded_patch = torch.cat([slot.encoded_patch for slot in self.slots])
+        tokens = torch.full((batch_size, 1), model.bos_token_id, device=device)
+        char_key_values = None
+        position = 0
+        while not all(finished):
+            probs, char_key_values = model.char_level_decoder.generate(
+                encoded_patch, tokens, char_key_values
+            )
+            tokens = torch.full((batch_size,), model.pad_token_id, dtype=torch.long, device=device)
+            sampling = []
+            for row in range(batch_size):
+                if position < len(forced[row]):
+                    tokens[row] = forced[row][position]
+
+                elif not finished[row]:
+                    sampling.append(row)
+
+            constrained = [row for row in sampling if row in automata]
+            if constrained:
+                probs[constrained] = mask_probs(
+                    probs[constrained], [automata[row] for row in constrained]
+                )
+
+            for (top_p, top_k, temperature), rows in groups.items():
+                rows = [row for row in rows if row in sampling]
+                if rows:
+                    row_probs = adjust_probs(
+                        probs[rows], top_p=top_p, top_k=top_k, temperature=temperature
+                    )
+                    tokens[rows] = sample_tokens(
+                        row_probs, [self.slots[row].random_state.generator for row in rows]
+                    )
+
+            for row in sampling:
+                generated[row, num_generated[row]] = tokens[row]
+                num_generated[row] += 1
+
+            # one sync per character to find the slots that reached eos
+            sampled = tokens.tolist()
+            for row in sampling:
+                finished[row] = (
+                    sampled[row] == model.eos_token_id or num_generated[row] == num_steps[row]
+                )
+                if row in automata:
+                    automata[row].advance(sampled[row])
+
+            tokens = tokens.unsqueeze(1)
+            position += 1
+
+        return [generated[row, : num_generated[row]] for row in range(batch_size)]
+
+    def run(self):
+        """
+        Decode until stop is called, waiting for requests when idle.
+        """
+        while self.running:
+            try:
+                busy = self.step()
+
+            except Exception as e:
+                self.fail(e)
+                raise
+
+            if not busy:
+                time.sleep(0.01)
+
+    def fail(self, error: Exception):
+        """
+        Fail the running and waiting requests with an error and stop decoding.
+        """
+        self.running = False
+        with self.lock:
+            self.error = error
+
+        self.drop_requests(error)
+
+    def drop_requests(self, error: Exception):
+        """
+        Fail the running and waiting requests with an error, the scheduler can still be started again.
+        """
+        with self.lock:
+            requests = [slot.request for slot in self.slots]
+            requests += [request for request, _ in self.waiting]
+            self.slots = []
+            self.waiting.clear()
+
+        for request in requests:
+            request.fail(error)
+
+    def start(self):
+        """
+        Start decoding in a background thread.
+        """
+        if self.thread == None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop decoding, the unfinished requests fail with a RuntimeError.
+        """
+        self.running = False
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+        self.drop_requests(RuntimeError("scheduler stopped"))
@@ -0,0 +1,135 @@
+import os
+import json
+import random
+from tqdm import tqdm
+from utils import Patchilizer
+from config import *
+
+
+class NGramDraft:
+    """
+    A character n-gram model of the bars in ABC notation.
+    It drafts the next characters of a patch for speculative decoding,
+    backing off to shorter contexts when a context has not been seen.
+    """
+
+    def __init__(self, order=4, eos_token_id=2):
+        self.order = order
+        self.eos_token_id = eos_token_id
+        # context -> (next tokens, their probabilities)
+        self.table = {}
+
+    def fit(self, patches: list):
+        """
+        Count the n-grams of the patches.
+        :param patches: the patches encoded by Patchilizer
+        """
+        counts = {}
+        for patch in tqdm(patches):
+            if self.eos_token_id in patch:
+                patch = patch[: patch.index(self.eos_token_id) + 1]
+
+            for t in range(1, len(patch)):
+                for n in range(min(self.order - 1, t) + 1):
+                    context = tuple(patch[t - n : t])
+                    next_counts = counts.setdefault(context, {})
+                    next_counts[patch[t]] = next_counts.get(patch[t], 0) + 1
+
+        self.table = {}
+        for context, next_counts in counts.items():
+            total = sum(next_counts.values())
+            self.table[context] = (
+                list(next_counts.keys()),
+                [count / total for count in next_counts.values()],
+            )
+
+        return self
+
+    def distribution(self, context: list):
+        """
+        The next token distribution after the longest seen suffix of the context.
+        :return: the next tokens and their probabilities
+        """
+        for n in range(min(self.order - 1, len(context)), -1, -1):
+            key = tuple(context[len(context) - n :])
+            if key in self.table:
+                return self.table[key]
+
+        return [self.eos_token_id], [1.0]
+
+    def propose(self, context: list, num_tokens: int, rng: random.Random = None):
+        """
+        Draft the next characters of a patch.
+        :param context: the tokens of the patch so far, starting with bos
+        :param num_tokens: the maximum number of tokens to draft
+        :param rng: the random state to sample with
+        :return: the drafted tokens and the distribution each of them was sampled from
+        """
+        rng = rng if rng != None else random
+        context = list(context)
+        tokens, probs = [], []
+        for _ in range(num_tokens):
+            next_tokens, next_probs = self.distribution(context)
+            token = rng.choices(next_tokens, weights=next_probs)[0]
+            tokens.append(token)
+            probs.append(dict(zip(next_tokens, next_probs)))
+            context.append(token)
+            if token == self.eos_token_id:
+                break
+
+        return tokens, probs
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "order": self.order,
+                    "eos_token_id": self.eos_token_id,
+                    "table": [
+                        [list(context), next_tokens, next_probs]
+                        for context, (next_tokens, next_probs) in self.table.items()
+                    ],
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as file:
+            data = json.load(file)
+
+        draft = cls(data["order"], data["eos_token_id"])
+        draft.table = {
+            tuple(context): (next_tokens, next_probs)
+            for context, next_tokens, next_probs in data["table"]
+        }
+        return draft
+
+
+def build_draft(subset: str, order=4):
+    """
+    Fit a draft model on the training split of a subset.
+    """
+    from modelscope.msdatasets import MsDataset
+
+    dataset = MsDataset.load(
+        f"monetjoe/{DATASET}",
+        subset_name=subset,
+        cache_dir=f"{TEMP_DIR}/cache",
+        trust_remote_code=True,
+    )
+    classes = dataset["train"].features["label"].names
+    patchilizer = Patchilizer()
+    patches = []
+    for song in dataset["train"]:
+        text = "A:" + classes[song["label"]] + "\n" + song["prompt"]
+        text += "\n".join(song["data"].split("\n")[1:])
+        patches += patchilizer.encode(text)
+
+    return NGramDraft(order).fit(patches)
+
+
+if __name__ == "__main__":
+    for subset in ["VGMIDI", "EMOPIA", "Rough4Q"]:
+        os.makedirs(f"{OUTPUT_PATH}/{subset}", exist_ok=True)
+        build_draft(subset).save(f"{OUTPUT_PATH}/{subset}/draft.json")
@@ -0,0 +1,70 @@
+from grammar import AbcAutomaton
+from patchilizer import Patchilizer
+
+# a tune of the training data format: the control codes, the header and a body over several lines
+TUNE = """A:Q1
+S:2
+B:9
+E:4
+B:9
+L:1/8
+M:4/4
+K:G
+|: GA | "G" B2 BA B2 d2 | "C" e2 ed e2 g2 | "G" d2 B2 G2 AB |
+"D" A2 (3FGA !fermata!d2 cB | "G" B2 BA B2 d2 |
+"C" e2 ed {f}e2 g2 | "D7" fe dc [DA]2 F2 | "G" G4 G2 :|
+K:D
+|: fg | a2 af d2 f2 | a2 af e2 fg |] [| a2 A2 A2 ||
+"""
+
+
+def accepts(patch: list, line_start=True) -> bool:
+    """
+    Whether the automaton allows every character of a patch and its eos.
+    """
+    automaton = AbcAutomaton(line_start=line_start)
+    for token in patch[1:]:
+        if not automaton.mask()[token]:
+            return False
+
+        if token == 2:
+            return True
+
+        automaton.advance(token)
+
+    return False
+
+
+def assert_tune_accepted(tune: str):
+    """
+    Check every patch of a tune, each starts a line when the patch before it ends one.
+    """
+    patches = Patchilizer().encode(tune)
+    bars = [Patchilizer().patch2bar(patch) for patch in patches]
+    for i, (patch, bar) in enumerate(zip(patches, bars)):
+        line_start = i == 0 or bars[i - 1].endswith("\n")
+        assert accepts(patch, line_start), repr(bar)
+
+    return bars
+
+
+def test_training_tune_bars_are_accepted():
+    bars = assert_tune_accepted(TUNE)
+    assert any(bar.startswith("\n") for bar in bars)
+
+
+def test_score_directive_is_accepted():
+    bars = assert_tune_accepted("L:1/8\nM:4/4\n%%score { 1 | 2 }\nK:G\nV:1\n|: GA | B2 c2 :|\n")
+    assert "%%score { 1 | 2 }\n" in bars
+
+
+def test_bars_starting_with_a_field_letter_are_accepted():
+    bars = assert_tune_accepted("L:1/8\nM:4/4\nK:G\n|: B2 GA|A:| B2 c2 |]\n")
+    assert "A:|" in bars
+    assert not accepts(Patchilizer().bar2patch("A:|"))
+
+
+def test_unbalanced_bars_are_rejected():
+    patchilizer = Patchilizer()
+    for bar in ['"G B2 |', "[DA B2 |", "{f e2 |", "!trill d2 |", 'A:\n']:
+        assert not accepts(patchilizer.bar2patch(bar)), repr(bar)
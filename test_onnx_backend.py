@@ -0,0 +1,60 @@
+import pytest
+import torch
+from transformers import GPT2Config
+from engine import GenerationEngine, GenerationParams
+from utils import TunesFormer
+from onnx_backend import OnnxTunesFormer, check_parity, export_onnx
+from config import *
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+PROMPT = "A:Q1\nL:1/8\nM:3/4\nK:D\n"
+
+
+def small_model():
+    """
+    A randomly initialised TunesFormer with two small layers per decoder.
+    """
+    torch.manual_seed(1)
+    patch_config = GPT2Config(
+        num_hidden_layers=2,
+        n_embd=64,
+        n_head=4,
+        max_length=PATCH_LENGTH,
+        max_position_embeddings=PATCH_LENGTH,
+        vocab_size=1,
+        initializer_range=0.2,
+    )
+    char_config = GPT2Config(
+        num_hidden_layers=2,
+        n_embd=64,
+        n_head=4,
+        max_length=PATCH_SIZE,
+        max_position_embeddings=PATCH_SIZE,
+        vocab_size=128,
+        initializer_range=0.2,
+    )
+    return TunesFormer(patch_config, char_config).eval()
+
+
+def test_greedy_onnx_generation_matches_eager(tmp_path):
+    model = small_model()
+    export_onnx(model, str(tmp_path))
+    params = GenerationParams(num_tunes=2, batch_size=2, max_patch=12, top_k=1, seed=0)
+    tunes = GenerationEngine(model).generate(PROMPT, params)
+    onnx_tunes = GenerationEngine.from_onnx(str(tmp_path)).generate(PROMPT, params)
+    assert any(tune.bars for tune in tunes)
+    assert [tune.bars for tune in onnx_tunes] == [tune.bars for tune in tunes]
+
+
+def test_onnx_decoders_match_eager(tmp_path):
+    model = small_model()
+    export_onnx(model, str(tmp_path))
+    patch_error, char_error = check_parity(
+        model,
+        OnnxTunesFormer(str(tmp_path)),
+        PROMPT + ' de |"D" f3 e d2 |"A" c3 B A2 |"D" d6 |]\n',
+    )
+    assert patch_error < 1e-4
+    assert char_error < 1e-4
@@ -1,6 +1,7 @@
 import os
 import json
 import time
+import argparse
 import random
 import shutil
 import torch
@@ -8,34 +9,25 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
 from torch.amp import autocast, GradScaler
-from utils import Patchilizer, TunesFormer, PatchilizedData, DEVICE
+from utils import Patchilizer, PatchilizedData, DEVICE
+from engine import build_model
 from modelscope.msdatasets import MsDataset
 from modelscope import snapshot_download
 from tqdm import tqdm
-from transformers import GPT2Config, get_scheduler
+from transformers import get_scheduler
 from config import *
 
 
-def init(bsz=4):
+def init(bsz=4, num_char_heads=0, char_exits=False):
     random.seed(42)
     batch_size = min(torch.cuda.device_count(), bsz)
     if batch_size < 1:
         batch_size = 1
 
     patchilizer = Patchilizer()
-    patch_config = GPT2Config(
-        num_hidden_layers=PATCH_NUM_LAYERS,
-        max_length=PATCH_LENGTH,
-        max_position_embeddings=PATCH_LENGTH,
-        vocab_size=1,
-    )
-    char_config = GPT2Config(
-        num_hidden_layers=CHAR_NUM_LAYERS,
-        max_length=PATCH_SIZE,
-        max_position_embeddings=PATCH_SIZE,
-        vocab_size=128,
-    )
-    model: nn.Module = TunesFormer(patch_config, char_config, SHARE_WEIGHTS).to(DEVICE)
+    model: nn.Module = build_model(
+        num_char_heads=num_char_heads, char_exits=char_exits
+    ).to(DEVICE)
     # print parameter number
     print(
         f"Parameter Number: {sum(p.numel() for p in model.parameters() if p.requires_grad)}"
@@ -63,9 +55,9 @@ def collate_batch(batch):
     return input_patches.to(DEVICE)
 
 
-def process_one_batch(batch, model):  # call model with a batch of input
+def process_one_batch(batch, model, finetune=False):  # call model with a batch of input
     input_patches = batch
-    loss: torch.Tensor = model(input_patches).loss
+    loss: torch.Tensor = model(input_patches, finetune=finetune).loss
     return loss.mean()
 
 
@@ -76,6 +68,7 @@ def train_epoch(
     is_autocast: bool,
     scaler: GradScaler,
     train_set: DataLoader,
+    finetune=False,
 ):  # do one epoch for training
     tqdm_train_set = tqdm(train_set)
     total_train_loss = 0
@@ -88,7 +81,7 @@ def train_epoch(
         try:
             if is_autocast:
                 with autocast(device_type=DEVICE):
-                    loss = process_one_batch(batch, model)
+                    loss = process_one_batch(batch, model, finetune)
 
                 if loss == None or torch.isnan(loss).item():
                     continue
@@ -98,7 +91,7 @@ def train_epoch(
                 scaler.update()
 
             else:
-                loss = process_one_batch(batch, model)
+                loss = process_one_batch(batch, model, finetune)
                 if loss == None or torch.isnan(loss).item():
                     continue
 
@@ -125,7 +118,7 @@ def train_epoch(
     return total_train_loss / (iter_idx - 1)
 
 
-def eval_epoch(model: nn.Module, eval_set):  # do one epoch for eval
+def eval_epoch(model: nn.Module, eval_set, finetune=False):  # do one epoch for eval
     tqdm_eval_set = tqdm(eval_set)
     total_eval_loss = 0
     iter_idx = 1
@@ -134,7 +127,7 @@ def eval_epoch(model: nn.Module, eval_set):  # do one epoch for eval
     # Evaluate data for one epoch
     for batch in tqdm_eval_set:
         with torch.no_grad():
-            loss = process_one_batch(batch, model)
+            loss = process_one_batch(batch, model, finetune)
             if loss == None or torch.isnan(loss).item():
                 continue
 
@@ -155,7 +148,7 @@ def clean_caches(folder_name: str, root_dir=f"{TEMP_DIR}/cache"):
                     return
 
 
-def train(subset: str, dld_mode="reuse_dataset_if_exists", bsz=1):
+def load_data(subset: str, dld_mode="reuse_dataset_if_exists"):
     if dld_mode == "force_redownload":
         clean_caches(subset)
 
@@ -185,6 +178,11 @@ def train(subset: str, dld_mode="reuse_dataset_if_exists", bsz=1):
             }
         )
 
+    return trainset, evalset
+
+
+def train(subset: str, dld_mode="reuse_dataset_if_exists", bsz=1):
+    trainset, evalset = load_data(subset, dld_mode)
     batch_size, patchilizer, model, scaler, is_autocast, optimizer = init(bsz)
 
     trainset = DataLoader(
@@ -285,7 +283,125 @@ def train(subset: str, dld_mode="reuse_dataset_if_exists", bsz=1):
     print(f"Best Eval Epoch: {str(best_epoch)}\nMin Eval Loss: {str(min_eval_loss)}")
 
 
+def finetune(
+    subset: str,
+    weights: str,
+    num_heads=0,
+    exits=False,
+    dld_mode="reuse_dataset_if_exists",
+    bsz=1,
+):
+    """
+    Fine-tune extra char-level heads and intermediate exits on top of trained weights,
+    the rest of the model stays frozen. The heads draft the characters after the next one
+    for speculative decoding, see CharLevelDecoder.propose, and the exits predict the next character
+    from the intermediate layers for early-exit decoding, see CharLevelDecoder.generate_early_exit.
+    The weights are saved to heads_weights.pth next to the trained ones, they load and decode like any other.
+    """
+    trainset, evalset = load_data(subset, dld_mode)
+    batch_size, patchilizer, model, scaler, is_autocast, _ = init(bsz, num_heads, exits)
+    base_model = model.module if torch.cuda.device_count() > 1 else model
+    checkpoint = torch.load(weights, weights_only=False)
+    base_model.load_state_dict(checkpoint["model"], strict=False)
+    char_level_decoder = base_model.char_level_decoder
+    base_model.requires_grad_(False)
+    char_level_decoder.heads.requires_grad_(True)
+    char_level_decoder.exits.requires_grad_(True)
+    optimizer = optim.AdamW(
+        [*char_level_decoder.heads.parameters(), *char_level_decoder.exits.parameters()],
+        lr=FINETUNE_LEARNING_RATE,
+    )
+
+    trainset = DataLoader(
+        PatchilizedData(trainset, patchilizer),
+        batch_size=batch_size,
+        collate_fn=collate_batch,
+        shuffle=True,
+    )
+
+    evalset = DataLoader(
+        PatchilizedData(evalset, patchilizer),
+        batch_size=batch_size,
+        collate_fn=collate_batch,
+        shuffle=True,
+    )
+
+    lr_scheduler: optim.lr_scheduler.LambdaLR = get_scheduler(
+        name="cosine",
+        optimizer=optimizer,
+        num_warmup_steps=FINETUNE_NUM_EPOCHS * len(trainset) // 10,
+        num_training_steps=FINETUNE_NUM_EPOCHS * len(trainset),
+    )
+
+    best_epoch = 0
+    min_eval_loss = float("inf")
+    os.makedirs(f"{OUTPUT_PATH}/{subset}", exist_ok=True)
+    for epoch in range(1, FINETUNE_NUM_EPOCHS + 1):
+        print(f"{'-' * 21}Fine-tune Epoch {str(epoch)}{'-' * 21}")
+        train_loss = train_epoch(
+            model,
+            optimizer,
+            lr_scheduler,
+            is_autocast,
+            scaler,
+            trainset,
+            finetune=True,
+        )
+        eval_loss = eval_epoch(model, evalset, finetune=True)
+        with open(
+            f"{OUTPUT_PATH}/{subset}/finetune_logs.jsonl", "a", encoding="utf-8"
+        ) as jsonl_file:
+            jsonl_file.write(
+                json.dumps(
+                    {
+                        "epoch": int(epoch),
+                        "train_loss": float(train_loss),
+                        "eval_loss": float(eval_loss),
+                        "time": f"{time.asctime(time.localtime(time.time()))}",
+                    }
+                )
+                + "\n"
+            )
+
+        if eval_loss < min_eval_loss:
+            best_epoch = epoch
+            min_eval_loss = eval_loss
+            torch.save(
+                {
+                    "model": base_model.state_dict(),
+                    "epoch": epoch,
+                    "best_epoch": best_epoch,
+                    "min_eval_loss": min_eval_loss,
+                    "time_stamp": time.strftime(
+                        "%a_%d_%b_%Y_%H_%M_%S", time.localtime()
+                    ),
+                },
+                f"{OUTPUT_PATH}/{subset}/heads_weights.pth",
+            )
+
+    print(f"Best Fine-tune Epoch: {str(best_epoch)}\nMin Fine-tune Loss: {str(min_eval_loss)}")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-heads",
+        type=int,
+        default=0,
+        help="fine-tune this many extra char-level heads on the trained weights of each subset instead of training",
+    )
+    parser.add_argument(
+        "-exits",
+        type=bool,
+        default=False,
+        help="fine-tune the early exits of the char-level decoder on the trained weights of each subset instead of training",
+    )
+    args = parser.parse_args()
     subsets = ["VGMIDI", "EMOPIA", "Rough4Q"]
     for subset in subsets:
-        train(subset, "force_redownload", 4)
+        if args.heads or args.exits:
+            weights = f"{OUTPUT_PATH}/{subset}/weights.pth"
+            finetune(subset, weights, args.heads, args.exits, bsz=4)
+
+        else:
+            train(subset, "force_redownload", 4)
@@ -1,116 +1,201 @@
 import os
-import re
+import copy
 import random
 import torch
 from torch.utils.data import Dataset
 from config import *
+from grammar import AbcAutomaton, mask_probs
+from patchilizer import Patchilizer
 from tqdm import tqdm
-from unidecode import unidecode
-from transformers import GPT2Model, GPT2LMHeadModel, PreTrainedModel
-from samplings import top_p_sampling, top_k_sampling, temperature_sampling
+from transformers import GPT2Model, GPT2LMHeadModel, PreTrainedModel, Cache, DynamicCache
+from transformers.modeling_outputs import CausalLMOutput
 
 os.environ["MODELSCOPE_LOG_LEVEL"] = "40"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 MSCORE = os.getenv("mscore")
 
 
-class Patchilizer:
+def adjust_probs(
+    probs: torch.Tensor,
+    top_p: float = 1,
+    top_k: int = 0,
+    temperature: float = 1,
+) -> torch.Tensor:
     """
-    A class for converting music bars to patches and vice versa.
+    Apply top-p, top-k and temperature to next token distributions on their device,
+    in the same order and with the same results as the samplings package.
+    :param probs: the probability distributions in shape [batch, vocab_size]
+    :return: the adjusted and renormalised probability distributions
     """
+    if 0 < top_p and top_p < 1:
+        sorted_probs, sorted_tokens = torch.sort(probs, dim=-1, descending=True)
+        tokens_to_remove = torch.cumsum(sorted_probs, dim=-1) > top_p
+        # keep the token that crosses top_p
+        tokens_to_remove = torch.cat(
+            (torch.zeros_like(tokens_to_remove[:, :1]), tokens_to_remove[:, :-1]),
+            dim=-1,
+        )
+        probs = probs.scatter(-1, sorted_tokens, sorted_probs * ~tokens_to_remove)
 
-    def __init__(self):
-        self.delimiters = ["|:", "::", ":|", "[|", "||", "|]", "|"]
-        self.regexPattern = f"({'|'.join(map(re.escape, self.delimiters))})"
-        self.pad_token_id = 0
-        self.bos_token_id = 1
-        self.eos_token_id = 2
+    if top_k > 0:
+        top_tokens = torch.topk(probs, min(top_k, probs.shape[-1]), dim=-1).indices
+        probs = torch.zeros_like(probs).scatter(
+            -1, top_tokens, probs.gather(-1, top_tokens)
+        )
 
-    def split_bars(self, body):
-        """
-        Split a body of music into individual bars.
-        """
-        bars = re.split(self.regexPattern, "".join(body))
-        bars = list(filter(None, bars))
-        # remove empty strings
-        if bars[0] in self.delimiters:
-            bars[1] = bars[0] + bars[1]
-            bars = bars[1:]
+    if temperature != 1:
+        probs = probs ** (1 / temperature)
 
-        bars = [bars[i * 2] + bars[i * 2 + 1] for i in range(len(bars) // 2)]
-        return bars
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+
+def sample_tokens(probs: torch.Tensor, generators: list) -> torch.Tensor:
+    """
+    Draw the next token of each sequence without leaving the device.
+    :param probs: the probability distributions in shape [batch, vocab_size]
+    :param generators: the torch.Generator of each sequence, None for the sequences without a seed
+    :return: the sampled tokens in shape [batch]
+    """
+    # sequences without a seed draw from the global random state, all at once
+    if all(generator == None for generator in generators):
+        return torch.multinomial(probs, 1).squeeze(1)
+
+    return torch.cat(
+        [
+            torch.multinomial(prob, 1, generator=generator)
+            for prob, generator in zip(probs, generators)
+        ]
+    )
+
+
+class RandomState:
+    """
+    The random state of a generated tune, seeded once and advanced by each of its draws.
+    A tune owns its state, so a seed gives the same tune whatever the batch and the other running generations.
+    """
 
-    def bar2patch(self, bar, patch_size=PATCH_SIZE):
+    def __init__(self, seed: int = None, device=DEVICE):
         """
-        Convert a bar into a patch of specified length.
+        :param seed: the seed of the tune, None to draw from the global random state, seeded from the system entropy
         """
-        patch = [self.bos_token_id] + [ord(c) for c in bar] + [self.eos_token_id]
-        patch = patch[:patch_size]
-        patch += [self.pad_token_id] * (patch_size - len(patch))
-        return patch
+        self.generator = None
+        if seed != None:
+            self.generator = torch.Generator(device)
+            self.generator.manual_seed(seed)
+
+        self.seed = seed
+        # the n-gram draft samples on the host
+        self.rng = random.Random(seed)
+
+
+class ExitStats:
+    """
+    The char-level layers run per sampled character by early-exit decoding.
+    """
+
+    def __init__(self):
+        self.num_tokens = 0
+        self.num_layers = 0
 
-    def patch2bar(self, patch):
+    def add(self, layers: list):
         """
-        Convert a patch into a bar.
+        Count the layers run for each sequence of a forward.
         """
-        return "".join(
-            chr(idx) if idx > self.eos_token_id else ""
-            for idx in patch
-            if idx != self.eos_token_id
-        )
+        self.num_tokens += len(layers)
+        self.num_layers += sum(layers)
+
+    @property
+    def average_layers(self):
+        return self.num_layers / max(self.num_tokens, 1)
+
+
+def sample_patch(
+    char_step,
+    batch_size: int,
+    tokens: torch.Tensor = None,
+    top_p: float = 1,
+    top_k: int = 0,
+    temperature: float = 1,
+    random_states: list = None,
+    device=DEVICE,
+    constrained: bool = False,
+    line_starts: list = None,
+):
+    """
+    Sample the next patch of several sequences character by character.
+    :param char_step: a function of the new tokens and the char-level cache, None at the start of the patch,
+    returning the next token distribution of each sequence and the updated cache
+    :param tokens: already generated tokens of the next patch in shape [batch, n], shared by all sequences
+    :param random_states: the RandomState of each sequence, advanced by its draws until its eos token
+    :param constrained: whether to mask the characters that can never complete a valid header line or bar
+    :param line_starts: whether the patch of each sequence starts a line, None when they all do
+    :return: the generated tokens in shape [batch, n], padded after the eos token, and possibly by up to
+    EOS_CHECK_INTERVAL - 1 columns of padding
+    """
+    pad_token_id, bos_token_id, eos_token_id = 0, 1, 2
+    if tokens == None:
+        tokens = torch.full((batch_size, 1), bos_token_id, device=device)
+
+    if random_states == None:
+        random_states = [RandomState(device=device) for _ in range(batch_size)]
+
+    num_steps = max(PATCH_SIZE - tokens.shape[1], 1)
+    generated = torch.full((batch_size, num_steps), pad_token_id, device=device)
+    char_key_values = None
+    new_tokens = tokens
+    automata = None
+    if constrained:
+        if line_starts == None:
+            line_starts = [True] * batch_size
+
+        automata = [
+            AbcAutomaton(row[1:], line_start=line_start)
+            for row, line_start in zip(tokens.tolist(), line_starts)
+        ]
+
+    if automata == None and all(state.generator == None for state in random_states):
+        # without seeds or a grammar the whole batch draws together on the device,
+        # the sequences past their eos draw padding and eos is checked every EOS_CHECK_INTERVAL characters
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        for step in range(num_steps):
+            probs, char_key_values = char_step(new_tokens, char_key_values)
+            probs = adjust_probs(probs, top_p=top_p, top_k=top_k, temperature=temperature)
+            sampled = torch.multinomial(probs, 1).squeeze(1).masked_fill(finished, pad_token_id)
+            generated[:, step] = sampled
+            finished |= sampled == eos_token_id
+            if (step + 1) % EOS_CHECK_INTERVAL == 0 and finished.all():
+                break
 
-    def encode(
-        self,
-        abc_code,
-        patch_length=PATCH_LENGTH,
-        patch_size=PATCH_SIZE,
-        add_special_patches=False,
-    ):
-        """
-        Encode music into patches of specified length.
-        """
-        lines = unidecode(abc_code).split("\n")
-        lines = list(filter(None, lines))  # remove empty lines
-
-        body = ""
-        patches = []
-
-        for line in lines:
-            if len(line) > 1 and (
-                (line[0].isalpha() and line[1] == ":") or line.startswith("%%score")
-            ):
-                if body:
-                    bars = self.split_bars(body)
-                    patches.extend(
-                        self.bar2patch(
-                            bar + "\n" if idx == len(bars) - 1 else bar, patch_size
-                        )
-                        for idx, bar in enumerate(bars)
-                    )
-                    body = ""
+            new_tokens = sampled.unsqueeze(1)
 
-                patches.append(self.bar2patch(line + "\n", patch_size))
+        return generated[:, : step + 1]
 
-            else:
-                body += line + "\n"
+    # only the sequences that have not reached eos draw, so each state advances as when generated alone
+    rows = list(range(batch_size))
+    for step in range(num_steps):
+        probs, char_key_values = char_step(new_tokens, char_key_values)
+        probs = probs[rows]
+        if automata != None:
+            probs = mask_probs(probs, [automata[row] for row in rows])
 
-        if body:
-            patches.extend(
-                self.bar2patch(bar, patch_size) for bar in self.split_bars(body)
-            )
+        probs = adjust_probs(probs, top_p=top_p, top_k=top_k, temperature=temperature)
+        sampled = sample_tokens(probs, [random_states[row].generator for row in rows])
+        new_tokens = torch.full((batch_size,), pad_token_id, device=device)
+        new_tokens[rows] = sampled
+        generated[:, step] = new_tokens
+        # one sync per character to find the sequences that reached eos
+        sampled = sampled.tolist()
+        if automata != None:
+            for row, token in zip(rows, sampled):
+                automata[row].advance(token)
 
-        if add_special_patches:
-            bos_patch = [self.bos_token_id] * (patch_size - 1) + [self.eos_token_id]
-            eos_patch = [self.bos_token_id] + [self.eos_token_id] * (patch_size - 1)
-            patches = [bos_patch] + patches + [eos_patch]
+        rows = [row for row, token in zip(rows, sampled) if token != eos_token_id]
+        if not rows:
+            break
 
-        return patches[:patch_length]
+        new_tokens = new_tokens.unsqueeze(1)
 
-    def decode(self, patches):
-        """
-        Decode patches into music.
-        """
-        return "".join(self.patch2bar(patch) for patch in patches)
+    return generated[:, : step + 1]
 
 
 class PatchLevelDecoder(PreTrainedModel):
@@ -124,43 +209,144 @@ class PatchLevelDecoder(PreTrainedModel):
         self.patch_embedding = torch.nn.Linear(PATCH_SIZE * 128, config.n_embd)
         torch.nn.init.normal_(self.patch_embedding.weight, std=0.02)
         self.base = GPT2Model(config)
+        self.columns = None
+        self.columns_key = None
 
-    def forward(self, patches: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self,
+        patches: torch.Tensor,
+        past_key_values: Cache = None,
+        use_cache: bool = False,
+    ) -> torch.Tensor:
         """
         The forward pass of the patch-level decoder model.
         :param patches: the patches to be encoded
+        :param past_key_values: the cached states of the patches encoded before
+        :param use_cache: whether to return the updated cache
         :return: the encoded patches
         """
-        patches = torch.nn.functional.one_hot(patches, num_classes=128).float()
-        patches = patches.reshape(len(patches), -1, PATCH_SIZE * 128)
-        patches = self.patch_embedding(patches.to(self.device))
+        patches = self.embed_patches(patches.to(self.device))
+
+        return self.base(
+            inputs_embeds=patches,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+        )
+
+    def embed_patches(self, patches: torch.Tensor) -> torch.Tensor:
+        """
+        Embed patches by summing the patch_embedding columns of their tokens,
+        which equals the one-hot patch times patch_embedding without building the one-hot.
+        :param patches: the patches to be embedded
+        :return: the patch embeddings
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE)
+        offsets = torch.arange(PATCH_SIZE, device=patches.device) * 128
+        embeddings = torch.nn.functional.embedding_bag(
+            (patches + offsets).reshape(-1, PATCH_SIZE),
+            self.embedding_columns(),
+            mode="sum",
+        )
+        embeddings = embeddings + self.patch_embedding.bias
+        return embeddings.reshape(len(patches), -1, embeddings.shape[-1])
 
-        return self.base(inputs_embeds=patches)
+    def embedding_columns(self) -> torch.Tensor:
+        """
+        The columns of patch_embedding as contiguous rows, embedding_bag copies a transposed view on every call.
+        Without gradients the copy is kept until the weight is loaded, updated in place, moved or cast.
+        """
+        weight = self.patch_embedding.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return weight.t()
+
+        key = (weight.data_ptr(), weight._version, weight.dtype, weight.device)
+        if self.columns_key != key:
+            self.columns = weight.detach().t().contiguous()
+            self.columns_key = key
+
+        return self.columns
+
+
+class PredictionHead(torch.nn.Module):
+    """
+    An extra head of the char-level decoder, a residual SiLU block on the last hidden state
+    whose output goes through the shared LM head.
+    """
+
+    def __init__(self, hidden_size: int):
+        super().__init__()
+        self.linear = torch.nn.Linear(hidden_size, hidden_size)
+        # start from the prediction of the next character
+        torch.nn.init.zeros_(self.linear.weight)
+        torch.nn.init.zeros_(self.linear.bias)
+
+    def forward(self, hidden_states: torch.Tensor):
+        return hidden_states + torch.nn.functional.silu(self.linear(hidden_states))
+
+
+def copy_states(block, hidden_states: torch.Tensor, past_key_values: Cache, cache_position: torch.Tensor):
+    """
+    Append the keys and values of a GPT-2 block skipped by early exit to the cache,
+    computed from the hidden states it would have got instead of running it.
+    """
+    attention = block.attn
+    hidden_states = block.ln_1(hidden_states.to(block.ln_1.weight.dtype))
+    _, keys, values = attention.c_attn(hidden_states).split(attention.split_size, dim=2)
+    shape = (*keys.shape[:-1], -1, attention.head_dim)
+    past_key_values.update(
+        keys.view(shape).transpose(1, 2),
+        values.view(shape).transpose(1, 2),
+        attention.layer_idx,
+        {"cache_position": cache_position},
+    )
+
+
+def masked_cross_entropy(logits: torch.Tensor, labels: torch.Tensor):
+    """
+    The mean cross entropy over the labels that are not -100, 0 when there are none.
+    """
+    loss = torch.nn.functional.cross_entropy(
+        logits.flatten(0, 1), labels.flatten(), ignore_index=-100, reduction="sum"
+    )
+    return loss / (labels != -100).sum().clamp(min=1)
 
 
 class CharLevelDecoder(PreTrainedModel):
     """
     A Char-level Decoder model for generating the characters within each bar patch sequentially.
     It inherits PreTrainedModel from transformers.
+    The optional extra heads predict the characters after the next one from the same hidden state,
+    head i the character i + 2 positions ahead, to draft characters for speculative decoding.
+    The optional exits adapt the hidden states of the intermediate layers to the final layer norm and LM head
+    for early-exit decoding, which uses the intermediate hidden states as they are without them.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, num_heads=0, exits=False):
         super().__init__(config)
         self.pad_token_id = 0
         self.bos_token_id = 1
         self.eos_token_id = 2
         self.base = GPT2LMHeadModel(config)
+        self.heads = torch.nn.ModuleList(
+            PredictionHead(config.n_embd) for _ in range(num_heads)
+        )
+        self.exits = torch.nn.ModuleList(
+            PredictionHead(config.n_embd)
+            for _ in range(config.num_hidden_layers - 1 if exits else 0)
+        )
 
     def forward(
         self,
         encoded_patches: torch.Tensor,
         target_patches: torch.Tensor,
         patch_sampling_batch_size: int,
+        finetune=False,
     ):
         """
         The forward pass of the char-level decoder model.
         :param encoded_patches: the encoded patches
         :param target_patches: the target patches
+        :param finetune: whether to return the loss of the extra heads and exits instead of the LM head
         :return: the decoded patches
         """
         # preparing the labels for model training
@@ -195,33 +381,332 @@ class CharLevelDecoder(PreTrainedModel):
             (encoded_patches.unsqueeze(1), inputs_embeds[:, 1:, :]), dim=1
         )
 
+        if finetune:
+            return self.finetune_loss(inputs_embeds, target_masks, labels)
+
         return self.base(
             inputs_embeds=inputs_embeds, attention_mask=target_masks, labels=labels
         )
 
-    def generate(self, encoded_patch: torch.Tensor, tokens: torch.Tensor):
+    def finetune_loss(
+        self,
+        inputs_embeds: torch.Tensor,
+        attention_mask: torch.Tensor,
+        labels: torch.Tensor,
+    ):
+        """
+        The loss of the extra heads and exits.
+        The loss of each head further ahead weighs HEAD_LOSS_DECAY times less, the exits weigh the same.
+        :return: the loss in a CausalLMOutput
+        """
+        outputs = self.base.transformer(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            output_hidden_states=bool(self.exits),
+        )
+        hidden_states = outputs["last_hidden_state"]
+        loss = 0
+        for i, head in enumerate(self.heads):
+            logits = self.base.lm_head(head(hidden_states[:, : -(i + 2)]))
+            loss = loss + HEAD_LOSS_DECAY**i * masked_cross_entropy(logits, labels[:, i + 2 :])
+
+        for i in range(len(self.exits)):
+            # the hidden states are given before each block, then after the final layer norm
+            logits = self.exit_logits(outputs.hidden_states[i + 1][:, :-1], i)
+            loss = loss + masked_cross_entropy(logits, labels[:, 1:]) / len(self.exits)
+
+        return CausalLMOutput(loss=loss)
+
+    def exit_logits(self, hidden_states: torch.Tensor, layer: int):
+        """
+        The logits of the LM head on the hidden states after an intermediate layer.
+        """
+        # blocks cast to a lower precision hand over their hidden states in it
+        hidden_states = hidden_states.float()
+        if self.exits:
+            hidden_states = self.exits[layer](hidden_states)
+
+        return self.base.lm_head(self.base.transformer.ln_f(hidden_states))
+
+    def generate(
+        self,
+        encoded_patch: torch.Tensor,
+        tokens: torch.Tensor,
+        past_key_values: Cache = None,
+    ):
         """
         The generate function for generating a patch based on the encoded patch and already generated tokens.
-        :param encoded_patch: the encoded patch
-        :param tokens: already generated tokens in the patch
-        :return: the probability distribution of next token
+        :param encoded_patch: the encoded patch, or one per sequence in shape [batch, n_embd]
+        :param tokens: already generated tokens in the patch, only the new ones when past_key_values is given
+        :param past_key_values: the char-level cache of the current patch, None to start the patch
+        :return: the probability distribution of next token and the updated cache
+        """
+        probs, past_key_values = self.decode(encoded_patch, tokens, past_key_values)
+        return probs[:, -1], past_key_values
+
+    def generate_early_exit(
+        self,
+        encoded_patch: torch.Tensor,
+        tokens: torch.Tensor,
+        past_key_values: Cache = None,
+        exit_threshold: float = 0.9,
+    ):
+        """
+        The early-exit version of generate: the LM head runs after each intermediate layer,
+        and a sequence stops at the first layer where the top token passes exit_threshold.
+        The layers above the exit get the keys and values of the exit hidden states,
+        so each sequence decodes the same whatever the other sequences of the batch do.
+        The first forward of a patch runs all layers.
+        :param exit_threshold: the probability of the top token to stop at
+        :return: the probability distribution of next token, the updated cache
+        and the number of layers run for each sequence
+        """
+        num_layers = self.config.num_hidden_layers
+        if past_key_values is None or tokens.shape[-1] != 1:
+            probs, past_key_values = self.generate(encoded_patch, tokens, past_key_values)
+            return probs, past_key_values, [num_layers] * len(probs)
+
+        transformer = self.base.transformer
+        tokens = tokens.reshape(-1, 1)
+        position = past_key_values.get_seq_length()
+        cache_position = torch.tensor([position], device=self.device)
+        hidden_states = transformer.wte(tokens) + transformer.wpe(cache_position)
+
+        probs = torch.zeros((len(tokens), self.config.vocab_size), device=self.device)
+        layers = torch.full((len(tokens),), num_layers, device=self.device)
+        exited = torch.zeros(len(tokens), dtype=torch.bool, device=self.device)
+        for i, block in enumerate(transformer.h):
+            if exited.all():
+                copy_states(block, hidden_states, past_key_values, cache_position)
+                continue
+
+            outputs = block(
+                hidden_states,
+                past_key_values=past_key_values,
+                cache_position=cache_position,
+                use_cache=True,
+            )
+            # the blocks return a tuple before transformers 5, a tensor after
+            if not isinstance(outputs, torch.Tensor):
+                outputs = outputs[0]
+            # the exited sequences feed their exit hidden states to the layers above
+            hidden_states = torch.where(
+                exited[:, None, None], hidden_states.to(outputs.dtype), outputs
+            )
+            if i < num_layers - 1:
+                exit_probs = torch.nn.functional.softmax(
+                    self.exit_logits(hidden_states[:, -1], i), dim=-1
+                )
+                confident = (exit_probs.max(dim=-1).values >= exit_threshold) & ~exited
+                probs[confident] = exit_probs[confident]
+                layers[confident] = i + 1
+                exited |= confident
+
+        if not exited.all():
+            logits = self.base.lm_head(transformer.ln_f(hidden_states[~exited, -1].float()))
+            probs[~exited] = torch.nn.functional.softmax(logits, dim=-1)
+
+        return probs, past_key_values, layers.tolist()
+
+    def decode(
+        self,
+        encoded_patch: torch.Tensor,
+        tokens: torch.Tensor,
+        past_key_values: Cache = None,
+        output_hidden_states=False,
+    ):
+        """
+        Run the decoder over tokens of the patch and get the next token distribution after each of them.
+        :param encoded_patch: the encoded patch, or one per sequence in shape [batch, n_embd]
+        :param tokens: already generated tokens in the patch, only the new ones when past_key_values is given
+        :param past_key_values: the char-level cache of the current patch, None to start the patch
+        :param output_hidden_states: whether to also return the last hidden states, the inputs of the heads
+        :return: the probability distributions in shape [batch, n, vocab_size] and the updated cache
         """
-        encoded_patch = encoded_patch.reshape(1, 1, -1)
-        tokens = tokens.reshape(1, -1)
+        encoded_patch = encoded_patch.reshape(-1, 1, encoded_patch.shape[-1])
+        tokens = tokens.reshape(len(encoded_patch), -1)
 
         # Get input embeddings
         tokens = torch.nn.functional.embedding(tokens, self.base.transformer.wte.weight)
 
         # Concatenate the encoded patch with the input embeddings
-        tokens = torch.cat((encoded_patch, tokens[:, 1:, :]), dim=1)
+        if past_key_values is None:
+            tokens = torch.cat((encoded_patch, tokens[:, 1:, :]), dim=1)
 
         # Get output from model
-        outputs = self.base(inputs_embeds=tokens)
+        outputs = self.base(
+            inputs_embeds=tokens,
+            past_key_values=past_key_values,
+            use_cache=True,
+            output_hidden_states=output_hidden_states,
+        )
+
+        # Get probabilities of next tokens
+        probs = torch.nn.functional.softmax(outputs.logits, dim=-1)
+        if output_hidden_states:
+            return probs, outputs.past_key_values, outputs.hidden_states[-1]
+
+        return probs, outputs.past_key_values
+
+    def propose(
+        self,
+        hidden_state: torch.Tensor,
+        num_tokens: int,
+        top_p: float = 1,
+        top_k: int = 0,
+        temperature: float = 1,
+        generator: torch.Generator = None,
+    ):
+        """
+        Draft the characters after the next one with the extra heads, all from the same hidden state.
+        :param hidden_state: the last hidden state of the position the next character is sampled from
+        :param num_tokens: the number of characters to draft, at most the number of heads
+        :return: the drafted tokens and the distributions they were drawn from in shape [n, vocab_size]
+        """
+        heads = self.heads[:num_tokens]
+        if hidden_state is None or not heads:
+            return [], torch.zeros((0, self.config.vocab_size), device=self.device)
+
+        logits = torch.stack([self.base.lm_head(head(hidden_state)) for head in heads])
+        probs = adjust_probs(
+            torch.nn.functional.softmax(logits.float(), dim=-1),
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+        )
+        tokens = torch.multinomial(probs, 1, generator=generator).squeeze(1)
+        return tokens.tolist(), probs
+
+    def generate_speculative(
+        self,
+        encoded_patch: torch.Tensor,
+        tokens: torch.Tensor,
+        draft,
+        num_draft: int,
+        num_steps: int,
+        top_p: float = 1,
+        top_k: int = 0,
+        temperature: float = 1,
+        generator: torch.Generator = None,
+        rng: random.Random = None,
+        constrained: bool = False,
+        line_start: bool = True,
+    ):
+        """
+        Generate a patch with speculative sampling: the draft proposes characters,
+        one forward verifies them all, and the accepted characters follow the same
+        distribution as sampling them one by one.
+        Without a draft the extra heads propose the characters from the hidden state of the last forward.
+        :param encoded_patch: the encoded patch of one sequence
+        :param tokens: the tokens the patch starts with
+        :param draft: the draft model, see speculative.NGramDraft, None to draft with the extra heads
+        :param num_draft: the number of characters drafted per forward
+        :param num_steps: the maximum number of tokens to generate
+        :param generator: the torch.Generator to draw with
+        :param rng: the random state of the draft
+        :param constrained: whether to mask the characters that can never complete a valid header line or bar
+        :param line_start: whether the patch starts a line
+        :return: the generated tokens, the number of drafted and accepted characters
+        """
+        context = tokens.tolist()
+        automaton = AbcAutomaton(context[1:], line_start=line_start) if constrained else None
+        pending = tokens
+        past_key_values = None
+        hidden_state = None
+        cache_length = 0
+        patch = []
+        num_drafted, num_accepted = 0, 0
+
+        while len(patch) < num_steps:
+            num_tokens = min(num_draft, num_steps - len(patch) - 1)
+            if draft != None:
+                draft_tokens, draft_probs = draft.propose(context, num_tokens, rng)
+                q = torch.zeros(
+                    (len(draft_tokens), self.config.vocab_size), device=self.device
+                )
+                for j, distribution in enumerate(draft_probs):
+                    q[j, list(distribution.keys())] = torch.tensor(
+                        list(distribution.values()), device=self.device
+                    )
+
+            else:
+                # the first forward of the patch has no hidden state to draft from yet
+                draft_tokens, q = self.propose(
+                    hidden_state,
+                    num_tokens,
+                    top_p=top_p,
+                    top_k=top_k,
+                    temperature=temperature,
+                    generator=generator,
+                )
+
+            num_tokens = len(draft_tokens)
+            inputs = torch.cat(
+                (pending, torch.tensor(draft_tokens, dtype=torch.long, device=self.device))
+            )
+            probs, past_key_values, hidden_states = self.decode(
+                encoded_patch, inputs, past_key_values, output_hidden_states=True
+            )
+            cache_length += len(inputs)
+            probs = probs[0, -(num_tokens + 1) :]
+            if automaton != None:
+                # each verified position is masked after the drafted tokens before it
+                automata = [automaton]
+                for token in draft_tokens:
+                    automata.append(copy.copy(automata[-1]))
+                    automata[-1].advance(token)
+
+                probs = mask_probs(probs, automata)
+
+            probs = adjust_probs(
+                probs,
+                top_p=top_p,
+                top_k=top_k,
+                temperature=temperature,
+            )
+
+            # accept each drafted token with probability min(1, p / q)
+            positions = torch.arange(num_tokens, device=self.device)
+            drafted = torch.tensor(draft_tokens, dtype=torch.long, device=self.device)
+            ratios = probs[positions, drafted] / q[positions, drafted]
+            uniforms = torch.rand(num_tokens, generator=generator, device=self.device)
+            accepts = (uniforms < ratios).tolist()
+            num_kept = accepts.index(False) if False in accepts else num_tokens
+            num_drafted += num_tokens
+            num_accepted += num_kept
+
+            kept_tokens = draft_tokens[:num_kept]
+            # the next character is sampled after the last kept token, the heads continue from there
+            hidden_state = hidden_states[0, num_kept - num_tokens - 1]
+            if self.eos_token_id in kept_tokens:
+                patch += kept_tokens[: kept_tokens.index(self.eos_token_id) + 1]
+                break
 
-        # Get probabilities of next token
-        probs = torch.nn.functional.softmax(outputs.logits.squeeze(0)[-1], dim=-1)
+            if num_kept < num_tokens:
+                # resample the rejected position from the residual distribution
+                residual = (probs[num_kept] - q[num_kept]).clamp(min=0)
+                if residual.sum() <= 0:
+                    residual = probs[num_kept]
 
-        return probs
+                past_key_values.crop(cache_length - (num_tokens - num_kept))
+                cache_length -= num_tokens - num_kept
+
+            else:
+                residual = probs[num_tokens]
+
+            token = torch.multinomial(residual, 1, generator=generator)
+            patch += kept_tokens + token.tolist()
+            if automaton != None:
+                for kept_token in kept_tokens + token.tolist():
+                    automaton.advance(kept_token)
+
+            context += kept_tokens + token.tolist()
+            if patch[-1] == self.eos_token_id:
+                break
+
+            pending = token
+
+        return patch, num_drafted, num_accepted
 
 
 class TunesFormer(PreTrainedModel):
@@ -231,7 +716,14 @@ class TunesFormer(PreTrainedModel):
     It inherits PreTrainedModel from transformers.
     """
 
-    def __init__(self, encoder_config, decoder_config, share_weights=False):
+    def __init__(
+        self,
+        encoder_config,
+        decoder_config,
+        share_weights=False,
+        num_char_heads=0,
+        char_exits=False,
+    ):
         super().__init__(encoder_config)
         self.pad_token_id = 0
         self.bos_token_id = 1
@@ -256,7 +748,7 @@ class TunesFormer(PreTrainedModel):
             decoder_config.max_position_embeddings = max_position_embeddings
 
         self.patch_level_decoder = PatchLevelDecoder(encoder_config)
-        self.char_level_decoder = CharLevelDecoder(decoder_config)
+        self.char_level_decoder = CharLevelDecoder(decoder_config, num_char_heads, char_exits)
 
         if share_weights:
             self.patch_level_decoder.base = self.char_level_decoder.base.transformer
@@ -265,10 +757,12 @@ class TunesFormer(PreTrainedModel):
         self,
         patches: torch.Tensor,
         patch_sampling_batch_size: int = PATCH_SAMPLING_BATCH_SIZE,
+        finetune=False,
     ):
         """
         The forward pass of the TunesFormer model.
         :param patches: the patches to be both encoded and decoded
+        :param finetune: whether to return the loss of the extra char-level heads and exits
         :return: the decoded patches
         """
         patches = patches.reshape(len(patches), -1, PATCH_SIZE)
@@ -278,15 +772,23 @@ class TunesFormer(PreTrainedModel):
             encoded_patches.squeeze(0)[:-1, :],
             patches.squeeze(0)[1:, :],
             patch_sampling_batch_size,
+            finetune,
         )
 
-    def norm(self, prob):
-        prob = [float(x) for x in prob]
-        s = sum(prob)
-        if s == 0:
-            raise ValueError("全零概率")
-
-        return [x / s for x in prob]
+    def encode(self, patches: torch.Tensor, past_key_values: Cache = None):
+        """
+        Encode patches with the patch-level decoder, continuing from the cached patches.
+        :param patches: the patches that are not in past_key_values yet
+        :param past_key_values: the patch-level cache, None to start from scratch
+        :return: the encoded patches and the updated cache
+        """
+        patches = patches.reshape(len(patches), -1, PATCH_SIZE)
+        outputs = self.patch_level_decoder(
+            patches,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        return outputs["last_hidden_state"], outputs["past_key_values"]
 
     def generate(
         self,
@@ -295,55 +797,423 @@ class TunesFormer(PreTrainedModel):
         top_p: float = 1,
         top_k: int = 0,
         temperature: float = 1,
-        seed: int = None,
+        random_state: RandomState = None,
+        past_key_values: Cache = None,
     ):
         """
         The generate function for generating patches based on patches.
-        :param patches: the patches to be encoded
+        :param patches: the patches to be encoded, only the new ones when past_key_values is given
+        :param random_state: the RandomState of the tune, advanced in place
+        :param past_key_values: the patch-level cache of the previous patches, updated in place
         :return: the generated patches
         """
-        patches = patches.reshape(len(patches), -1, PATCH_SIZE)
-        encoded_patches = self.patch_level_decoder(patches)["last_hidden_state"]
+        if tokens != None:
+            tokens = tokens.reshape(1, -1)
+
+        generated = self.generate_batch(
+            patches.reshape(1, -1, PATCH_SIZE),
+            tokens,
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+            random_states=None if random_state == None else [random_state],
+            past_key_values=past_key_values,
+        )
+        generated_patch = generated[0].tolist()
+        if self.eos_token_id in generated_patch:
+            generated_patch = generated_patch[: generated_patch.index(self.eos_token_id) + 1]
 
-        if tokens == None:
-            tokens = torch.tensor([self.bos_token_id], device=self.device)
+        return generated_patch
 
-        generated_patch = []
-        random.seed(seed)
+    def generate_batch(
+        self,
+        patches: torch.Tensor,
+        tokens: torch.Tensor,
+        top_p: float = 1,
+        top_k: int = 0,
+        temperature: float = 1,
+        random_states: list = None,
+        past_key_values: Cache = None,
+        prefix: "PrefixState" = None,
+        constrained: bool = False,
+        line_starts: list = None,
+        exit_threshold: float = None,
+        exit_stats: ExitStats = None,
+    ):
+        """
+        The generate function for generating the next patch of several sequences together.
+        Each sequence draws from its own RandomState, so it samples the same patch as when generated alone.
+        :param patches: the patches to be encoded in shape [batch, n, PATCH_SIZE]
+        :param tokens: already generated tokens of the next patch in shape [batch, n], shared by all sequences
+        :param random_states: the RandomState of each sequence, advanced in place, None to seed from the system entropy
+        :param past_key_values: the patch-level cache of the previous patches, updated in place
+        :param prefix: the state after the prompt when generating its first patch, the patches are empty
+        and past_key_values already holds the prompt
+        :param constrained: whether to mask the characters that can never complete a valid header line or bar
+        :param line_starts: whether the patch of each sequence starts a line, None when they all do
+        :param exit_threshold: the top token probability to exit the char-level decoder early at, None to run all layers
+        :param exit_stats: the ExitStats to count the char-level layers run into
+        :return: the generated tokens in shape [batch, n], padded after the eos token
+        """
+        batch_size = len(patches)
+        if prefix != None:
+            encoded_patch = prefix.encoded_patch.expand(batch_size, -1)
 
-        while True:
-            if seed != None:
-                n_seed = random.randint(0, 1000000)
-                random.seed(n_seed)
+        else:
+            encoded_patches, _ = self.encode(patches, past_key_values)
+            encoded_patch = encoded_patches[:, -1]
 
-            else:
-                n_seed = None
+        # the sequences past their eos token keep decoding padding, they are left out of exit_stats
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+
+        def decode_step(new_tokens, char_key_values):
+            if exit_threshold == None:
+                return self.char_level_decoder.generate(
+                    encoded_patch, new_tokens, char_key_values
+                )
 
-            prob = (
-                self.char_level_decoder.generate(encoded_patches[0][-1], tokens)
-                .cpu()
-                .detach()
-                .numpy()
+            probs, char_key_values, layers = self.char_level_decoder.generate_early_exit(
+                encoded_patch, new_tokens, char_key_values, exit_threshold
             )
+            if exit_stats != None:
+                finished[new_tokens[:, -1] == self.eos_token_id] = True
+                exit_stats.add([layers[row] for row in (~finished).nonzero()[:, 0].tolist()])
+
+            return probs, char_key_values
+
+        def char_step(new_tokens, char_key_values):
+            # the prompt tokens of the patch are already decoded
+            if prefix != None and char_key_values == None:
+                return (
+                    prefix.probs.expand(batch_size, -1),
+                    repeat_cache(prefix.char_key_values, batch_size),
+                )
 
-            prob = top_p_sampling(prob, top_p=top_p, return_probs=True)
-            prob = top_k_sampling(prob, top_k=top_k, return_probs=True)
-            token = temperature_sampling(
-                self.norm(prob),
+            return decode_step(new_tokens, char_key_values)
+
+        return sample_patch(
+            char_step,
+            batch_size,
+            tokens,
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+            random_states=random_states,
+            device=self.device,
+            constrained=constrained,
+            line_starts=line_starts,
+        )
+
+    def encode_prefix(self, patches: torch.Tensor, tokens: torch.Tensor):
+        """
+        Run both decoders over a prompt, up to the distribution of the first generated character.
+        :param patches: the complete patches of the prompt in shape [1, n, PATCH_SIZE]
+        :param tokens: the tokens its unfinished last bar starts with in shape [1, n]
+        :return: the PrefixState of the prompt
+        """
+        patch_key_values = DynamicCache()
+        encoded_patches, _ = self.encode(patches, patch_key_values)
+        encoded_patch = encoded_patches[:, -1]
+        probs, char_key_values = self.char_level_decoder.generate(encoded_patch, tokens)
+        return PrefixState(patch_key_values, encoded_patch, char_key_values, probs)
+
+    def generate_speculative(
+        self,
+        patches: torch.Tensor,
+        tokens: torch.Tensor,
+        draft,
+        num_draft: int = 4,
+        top_p: float = 1,
+        top_k: int = 0,
+        temperature: float = 1,
+        random_states: list = None,
+        past_key_values: Cache = None,
+        constrained: bool = False,
+        line_starts: list = None,
+    ):
+        """
+        The speculative version of generate_batch, the patches are encoded together
+        and the characters of each sequence are drafted and verified one sequence at a time.
+        :param draft: the draft model, see speculative.NGramDraft, None to draft with the extra char-level heads
+        :param num_draft: the number of characters drafted per forward
+        :param constrained: whether to mask the characters that can never complete a valid header line or bar
+        :param line_starts: whether the patch of each sequence starts a line, None when they all do
+        :return: the generated tokens in shape [batch, n], padded after the eos token,
+        and the numbers of drafted and accepted characters
+        """
+        batch_size = len(patches)
+        encoded_patches, _ = self.encode(patches, past_key_values)
+
+        if tokens == None:
+            tokens = torch.full((batch_size, 1), self.bos_token_id, device=self.device)
+
+        if random_states == None:
+            random_states = [RandomState(device=self.device) for _ in range(batch_size)]
+
+        num_steps = max(PATCH_SIZE - tokens.shape[1], 1)
+        generated = torch.full(
+            (batch_size, num_steps), self.pad_token_id, device=self.device
+        )
+        num_drafted, num_accepted = 0, 0
+        for i, random_state in enumerate(random_states):
+            patch, drafted, accepted = self.char_level_decoder.generate_speculative(
+                encoded_patches[i, -1],
+                tokens[i],
+                draft,
+                num_draft,
+                num_steps,
+                top_p=top_p,
+                top_k=top_k,
                 temperature=temperature,
-                seed=n_seed,
+                generator=random_state.generator,
+                rng=random_state.rng,
+                constrained=constrained,
+                line_start=line_starts == None or line_starts[i],
             )
+            generated[i, : len(patch)] = torch.tensor(patch, device=self.device)
+            num_drafted += drafted
+            num_accepted += accepted
+
+        return generated, (num_drafted, num_accepted)
 
-            generated_patch.append(token)
-            if token == self.eos_token_id or len(tokens) >= PATCH_SIZE - 1:
+
+class PrefixState:
+    """
+    The state of both decoders after a prompt, shared by the tunes generated from it.
+    It is never updated, the tunes decode from copies of its caches.
+    """
+
+    def __init__(
+        self,
+        patch_key_values: DynamicCache,
+        encoded_patch: torch.Tensor,
+        char_key_values: DynamicCache,
+        probs: torch.Tensor,
+    ):
+        self.patch_key_values = patch_key_values
+        self.encoded_patch = encoded_patch
+        self.char_key_values = char_key_values
+        self.probs = probs
+
+    def nbytes(self) -> int:
+        tensors = [self.encoded_patch, self.probs]
+        for cache in (self.patch_key_values, self.char_key_values):
+            for layer in cache.layers:
+                tensors += [layer.keys, layer.values]
+
+        return sum(x.numel() * x.element_size() for x in tensors)
+
+
+def repeat_cache(cache: DynamicCache, batch_size: int) -> DynamicCache:
+    """
+    Copy the cache of a single sequence for each sequence of a batch.
+    """
+    repeated = DynamicCache()
+    for i, layer in enumerate(cache.layers):
+        repeated.update(
+            layer.keys.repeat_interleave(batch_size, dim=0),
+            layer.values.repeat_interleave(batch_size, dim=0),
+            i,
+        )
+
+    return repeated
+
+
+class GenerationState:
+    """
+    The patches of a batch of tunes generated from the same prompt.
+    The buffers are allocated once and the sampled patches are written in place,
+    bars are only decoded into strings when they are asked for.
+    """
+
+    def __init__(
+        self,
+        patchilizer: Patchilizer,
+        prompt: str,
+        batch_size: int,
+        max_patch: int = PATCH_LENGTH,
+        device=DEVICE,
+    ):
+        self.patchilizer = patchilizer
+        self.prompt = prompt
+        prompt_patches = patchilizer.encode(prompt, add_special_patches=True)[:-1]
+        prefix = patchilizer.decode(prompt_patches)
+        # the characters of the unfinished last bar of the prompt
+        self.remaining_tokens = prompt[len(prefix) :]
+        self.prompt_length = len(prompt_patches)
+        self.patches = torch.full(
+            (batch_size, max(max_patch, self.prompt_length), PATCH_SIZE),
+            patchilizer.pad_token_id,
+            device=device,
+        )
+        self.patches[:, : self.prompt_length] = torch.tensor(
+            prompt_patches, device=device
+        )
+        self.tokens = torch.full(
+            (batch_size, PATCH_SIZE), patchilizer.pad_token_id, device=device
+        )
+        self.tokens[:, 0] = patchilizer.bos_token_id
+        self.num_tokens = min(1 + len(self.remaining_tokens), PATCH_SIZE)
+        self.tokens[:, 1 : self.num_tokens] = torch.tensor(
+            [ord(c) for c in self.remaining_tokens[: self.num_tokens - 1]],
+            device=device,
+        )
+        self.num_patches = self.prompt_length
+        self.num_encoded = 0
+        # beyond PATCH_LENGTH patches, the patch-level window holds the first num_pinned patches
+        # followed by the patches from window_start, see slide_window
+        self.num_pinned = 0
+        self.window_start = 0
+        self.lengths = [self.prompt_length] * batch_size
+        # the number of tokens sampled for the last patch of each tune
+        self.num_sampled = [0] * batch_size
+        self.total_sampled = [0] * batch_size
+        # whether each tune was stopped by a deadline or token budget before its eos
+        self.truncated = [False] * batch_size
+        self.active = list(range(batch_size))
+
+    @property
+    def num_positions(self) -> int:
+        """
+        The patch positions the window takes once all patches are encoded.
+        """
+        return self.num_pinned + self.num_patches - self.window_start
+
+    def num_header(self, i: int) -> int:
+        """
+        The number of leading patches of a tune up to its last header line, the bos patch included.
+        """
+        num_header = 1
+        for patch in self.patches[i, 1 : self.num_patches].tolist():
+            if not self.patchilizer.is_header_line(self.patchilizer.patch2bar(patch)):
                 break
 
-            else:
-                tokens = torch.cat(
-                    (tokens, torch.tensor([token], device=self.device)), dim=0
-                )
+            num_header += 1
+
+        return num_header
+
+    def slide_window(self, num_evicted: int):
+        """
+        Evict the oldest bars from the patch-level window so the next patch fits in PATCH_LENGTH positions.
+        The header lines of the tunes, at most half the positions, stay pinned at the start of the window,
+        so the caller crops its patch-level cache to num_pinned and the bars left in the window are encoded again.
+        :param num_evicted: the number of bars evicted at once, more re-encode less often but keep less context
+        """
+        if self.window_start == 0:
+            self.num_pinned = min(
+                max(self.num_header(i) for i in self.active), PATCH_LENGTH // 2
+            )
+            self.window_start = self.num_pinned
+
+        self.window_start = min(
+            max(
+                self.window_start + num_evicted,
+                self.num_pinned + self.num_patches - PATCH_LENGTH,
+            ),
+            self.num_patches - 1,
+        )
+        self.num_encoded = self.window_start
+
+    def new_patches(self) -> torch.Tensor:
+        """
+        The patches of the active tunes that have not been encoded yet.
+        """
+        patches = self.patches[self.active, self.num_encoded : self.num_patches]
+        self.num_encoded = self.num_patches
+        return patches
+
+    def next_tokens(self) -> torch.Tensor:
+        """
+        The tokens the next patch of the active tunes starts with.
+        """
+        return self.tokens[self.active, : self.num_tokens]
+
+    def line_starts(self) -> list:
+        """
+        Whether the next patch of each active tune starts a line, that is the patch before it ends one.
+        """
+        if self.num_patches == 1:
+            return [True] * len(self.active)
+
+        previous = self.patches[self.active, self.num_patches - 1]
+        return (previous == ord("\n")).any(dim=1).tolist()
 
-        return generated_patch, n_seed
+    def commit(self, generated: torch.Tensor):
+        """
+        Write the generated patches of the active tunes into the patch buffer.
+        It keeps the same characters as Patchilizer.bar2patch on the decoded bar,
+        and ends the tunes whose patch starts with eos or holds no characters.
+        :param generated: the generated tokens of the active tunes in shape [batch, n]
+        :return: the rows of the tunes that are still active
+        """
+        eos_token_id = self.patchilizer.eos_token_id
+        is_char = generated > eos_token_id
+        # move the characters left over the special tokens, dropping the overflow
+        index = torch.cumsum(is_char, dim=1) - 1 + self.num_tokens
+        index = index.masked_fill(~is_char | (index >= PATCH_SIZE), PATCH_SIZE)
+        tokens = torch.cat(
+            (self.tokens[self.active], torch.zeros_like(self.tokens[self.active, :1])),
+            dim=1,
+        )
+        tokens[:, self.num_tokens :] = self.patchilizer.pad_token_id
+        tokens.scatter_(1, index, generated)
+        num_chars = is_char.sum(dim=1)
+        end = (num_chars + self.num_tokens).clamp(max=PATCH_SIZE)
+        tokens.scatter_(1, end.unsqueeze(1), eos_token_id)
+        self.patches[self.active, self.num_patches] = tokens[:, :PATCH_SIZE]
+
+        ended = (generated[:, 0] == eos_token_id) | (num_chars == 0)
+        is_eos = generated == eos_token_id
+        num_sampled = torch.where(
+            is_eos.any(dim=1), torch.argmax(is_eos.int(), dim=1) + 1, generated.shape[1]
+        )
+        ended, num_sampled = torch.stack((ended.long(), num_sampled)).tolist()
+        for i, n in zip(self.active, num_sampled):
+            self.num_sampled[i] = n
+            self.total_sampled[i] += n
+
+        kept = [row for row, is_ended in enumerate(ended) if not is_ended]
+        self.active = [self.active[row] for row in kept]
+        for i in self.active:
+            self.lengths[i] += 1
+
+        self.num_patches += 1
+        self.num_tokens = 1
+        return kept
+
+    def truncate(self, rows: list):
+        """
+        End active tunes after their last complete bar and mark them as truncated.
+        :param rows: the rows of the tunes to end among the active ones
+        :return: the rows of the tunes that are still active
+        """
+        for row in rows:
+            self.truncated[self.active[row]] = True
+
+        kept = [row for row in range(len(self.active)) if row not in rows]
+        self.active = [self.active[row] for row in kept]
+        return kept
+
+    def bar(self, i: int, index: int) -> str:
+        """
+        Decode a generated bar of a tune.
+        :param i: the index of the tune
+        :param index: the index of the bar among the generated ones
+        """
+        patch = self.patches[i, self.prompt_length + index].tolist()
+        bar = self.patchilizer.patch2bar(patch)
+        if index == 0:
+            bar = bar[len(self.remaining_tokens) :]
+
+        return bar
+
+    def bars(self, i: int) -> list:
+        """
+        Decode the generated bars of a tune.
+        """
+        return [
+            self.bar(i, index) for index in range(self.lengths[i] - self.prompt_length)
+        ]
 
 
 class PatchilizedData(Dataset):